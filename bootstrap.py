@@ -0,0 +1,75 @@
+import warnings
+import numpy as np
+
+# Function to draw bootstrap resamples of n observations as one (n_boot, n) index matrix.
+# block_size > 1 draws circular moving blocks, keeping the autocorrelation within each block
+def resample_indices(n, n_boot, block_size=1, rng=None):
+    rng = np.random.default_rng(rng)
+    if block_size <= 1:
+        return rng.integers(0, n, size=(n_boot, n))
+    n_blocks = -(-n // block_size)
+    starts = rng.integers(0, n, size=(n_boot, n_blocks, 1))
+    return ((starts + np.arange(block_size)) % n).reshape(n_boot, -1)[:, :n]
+
+# Function to turn a (n_boot, n) index matrix into how many times each observation is drawn
+def resample_weights(idx, n):
+    offsets = n * np.arange(len(idx))[:, np.newaxis]
+    return np.bincount((idx + offsets).ravel(), minlength=len(idx) * n).reshape(len(idx), n).astype('f8')
+
+# Function to compute weighted OLS slopes of the columns of y (n, k) against x (n,) for every
+# row of weights w (n_boot, n), skipping NaN, with a few matrix products
+def weighted_slopes(w, x, y):
+    valid = ~np.isnan(y)
+    # Centre the data first so the one-pass sums do not lose precision
+    xv = np.where(valid, (x - np.nanmean(x))[:, np.newaxis], 0.0)
+    yv = np.where(valid, y - np.nanmean(y, axis=0), 0.0)
+    s, sx, sy = w @ valid, w @ xv, w @ yv
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (s * (w @ (xv * yv)) - sx * sy) / (s * (w @ (xv * xv)) - sx ** 2)
+
+# Function to compute weighted means of the columns of y (n, k) for every row of w, skipping NaN
+def weighted_means(w, y):
+    valid = ~np.isnan(y)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (w @ np.where(valid, y, 0.0)) / (w @ valid)
+
+# Function to evaluate a weighted statistic over n_boot resamples of the n observations, in
+# chunks of resamples that fit in max_chunk_mb; returns the (n_boot, k) bootstrap distribution
+def bootstrap_samples(statistic, n, n_boot, block_size, seed, max_chunk_mb):
+    rng = np.random.default_rng(seed)
+    chunk = max(1, int(max_chunk_mb * 2 ** 20 // (8 * 2 * n)))
+    samples = []
+    for start in range(0, n_boot, chunk):
+        idx = resample_indices(n, min(chunk, n_boot - start), block_size, rng)
+        samples.append(statistic(resample_weights(idx, n)))
+    return np.concatenate(samples)
+
+# Function to get the percentile confidence interval of a bootstrap distribution
+def percentile_ci(samples, ci=0.95):
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        low, high = np.nanpercentile(samples, [50 * (1 - ci), 50 * (1 + ci)], axis=0)
+    return low, high
+
+# Function to estimate OLS trends of one or more series (columns of y, NaN allowed) sampled at
+# x, with bootstrap confidence intervals. Returns (slope, ci_low, ci_high), one value per series
+def bootstrap_trends(x, y, n_boot=10000, block_size=1, ci=0.95, seed=0, max_chunk_mb=256):
+    x = np.asarray(x, dtype='f8')
+    y = np.asarray(y, dtype='f8')
+    y = y[:, np.newaxis] if y.ndim == 1 else y
+    if len(x) == 0:
+        return tuple(np.full(y.shape[1], np.nan) for _ in range(3))
+    slope = weighted_slopes(np.ones((1, len(x))), x, y)[0]
+    samples = bootstrap_samples(lambda w: weighted_slopes(w, x, y), len(x), n_boot, block_size, seed, max_chunk_mb)
+    return (slope, *percentile_ci(samples, ci))
+
+# Function to estimate the means of one or more series (columns of y, NaN allowed) with
+# bootstrap confidence intervals. Returns (mean, ci_low, ci_high), one value per series
+def bootstrap_means(y, n_boot=10000, block_size=1, ci=0.95, seed=0, max_chunk_mb=256):
+    y = np.asarray(y, dtype='f8')
+    y = y[:, np.newaxis] if y.ndim == 1 else y
+    if len(y) == 0:
+        return tuple(np.full(y.shape[1], np.nan) for _ in range(3))
+    mean = weighted_means(np.ones((1, len(y))), y)[0]
+    samples = bootstrap_samples(lambda w: weighted_means(w, y), len(y), n_boot, block_size, seed, max_chunk_mb)
+    return (mean, *percentile_ci(samples, ci))
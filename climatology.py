@@ -0,0 +1,173 @@
+import os
+import re
+import numpy as np
+import pandas as pd
+from netCDF4 import Dataset
+
+# Season definitions: calendar quarters (as in seasonal_average_grid.py) and the astronomical
+# seasons of seasonal_meteorology_plot.py, given as (month, day) start and end dates
+QUARTER_SEASONS = {'Winter': (1, 2, 3), 'Spring': (4, 5, 6), 'Summer': (7, 8, 9), 'Autumn': (10, 11, 12)}
+ASTRONOMICAL_SEASONS = {
+    'Winter': [(1, 1), (3, 20)],
+    'Spring': [(3, 21), (6, 20)],
+    'Summer': [(6, 21), (9, 22)],
+    'Autumn': [(9, 23), (12, 20)]
+}
+
+# Windows the climatology engine can accumulate
+WINDOWS = ('month', 'season', 'year_season', 'year', 'annual')
+
+# Streaming per-pixel statistics (Welford): count, mean and M2 (sum of squared deviations)
+# kept in float64. NaN and masked values are ignored, so missing pixels do not bias the mean
+class WelfordAccumulator:
+
+    def __init__(self, shape):
+        self.count = np.zeros(shape, dtype='i8')
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+
+    # Function to add one field of the accumulator's shape, or a stack of them (k, ...)
+    def add(self, data):
+        data = np.ma.filled(np.ma.asarray(data, dtype='f8'), np.nan)
+        if data.ndim == self.mean.ndim:
+            data = data[np.newaxis]
+        for field in data:
+            valid = ~np.isnan(field)
+            self.count += valid
+            with np.errstate(divide='ignore', invalid='ignore'):
+                delta = np.where(valid, field - self.mean, 0.0)
+                self.mean += np.where(valid, delta / self.count, 0.0)
+                self.m2 += np.where(valid, delta * (field - self.mean), 0.0)
+
+    # Function to merge another accumulator (e.g. from another worker) into this one (Chan et al.)
+    def merge(self, other):
+        count = self.count + other.count
+        with np.errstate(divide='ignore', invalid='ignore'):
+            delta = other.mean - self.mean
+            weight = np.where(count > 0, other.count / count, 0.0)
+            self.mean = self.mean + delta * weight
+            self.m2 = self.m2 + other.m2 + delta ** 2 * self.count * weight
+        self.count = count
+
+    # Function to get the mean, standard deviation and valid count; pixels without data get
+    # NaN, and the standard deviation needs more than ddof values
+    def result(self, ddof=1):
+        mean = np.where(self.count > 0, self.mean, np.nan)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            std = np.where(self.count > ddof, np.sqrt(self.m2 / (self.count - ddof)), np.nan)
+        return mean, std, self.count.copy()
+
+
+# Function to get the dates of the fields in a file: daily cubes carry a 't' axis
+# (days since 1990-01-01), monthly means are dated mid-month from their name (_YYYY_MM)
+def file_dates(ds, name):
+    if 't' in ds.variables:
+        return pd.to_datetime('1990-01-01') + pd.to_timedelta(np.asarray(ds.variables['t'][:]), unit='D')
+    match = re.search(r'_(\d{4})_(\d{2})', name)
+    if match is None:
+        raise ValueError(f"Cannot tell the date of {name}")
+    return pd.DatetimeIndex([f"{match.group(1)}-{match.group(2)}-15"])
+
+# Function to get the season name of each date ('' for dates outside every season)
+def season_names(dates, seasons='quarters'):
+    dates = pd.DatetimeIndex(dates)
+    month, day = dates.month.to_numpy(), dates.day.to_numpy()
+    names = np.full(len(dates), '', dtype=object)
+    if seasons == 'quarters':
+        for name, months in QUARTER_SEASONS.items():
+            names[np.isin(month, months)] = name
+    elif seasons == 'astronomical':
+        for name, (start, end) in ASTRONOMICAL_SEASONS.items():
+            mask = ((month > start[0]) | ((month == start[0]) & (day >= start[1]))) & \
+                   ((month < end[0]) | ((month == end[0]) & (day <= end[1])))
+            names[mask] = name
+    else:
+        raise ValueError(f"Unknown season definition: {seasons}")
+    return names
+
+# Function to get the key of each date for one window type ('' where the date is in no window)
+def window_keys(dates, window, seasons='quarters'):
+    dates = pd.DatetimeIndex(dates)
+    if window == 'month':
+        return np.array([f"month_{m:02d}" for m in dates.month], dtype=object)
+    if window == 'season':
+        return np.array([f"season_{n}" if n else '' for n in season_names(dates, seasons)], dtype=object)
+    if window == 'year_season':
+        return np.array([f"season_{y}_{n}" if n else '' for y, n in zip(dates.year, season_names(dates, seasons))],
+                        dtype=object)
+    if window == 'year':
+        return np.array([f"year_{y}" for y in dates.year], dtype=object)
+    if window == 'annual':
+        return np.full(len(dates), 'annual', dtype=object)
+    raise ValueError(f"Unknown climatology window: {window}")
+
+# Gridded climatology of several windows at once: every field read is added to the
+# accumulator of each window it belongs to (its month, season, year-season, ...)
+class ClimatologyEngine:
+
+    def __init__(self, shape, windows=('month', 'season', 'year_season', 'annual'), seasons='quarters'):
+        for window in windows:
+            if window not in WINDOWS:
+                raise ValueError(f"Unknown climatology window: {window}")
+        self.shape = tuple(shape)
+        self.windows = tuple(windows)
+        self.seasons = seasons
+        self.accumulators = {}
+
+    # Function to add a field (one date) or a (t, ...) stack of fields with their dates
+    def add(self, dates, data):
+        dates = pd.DatetimeIndex(np.atleast_1d(dates))
+        data = np.ma.filled(np.ma.asarray(data, dtype='f8'), np.nan)
+        if data.ndim == len(self.shape):
+            data = data[np.newaxis]
+        if len(data) != len(dates):
+            raise ValueError(f"Got {len(dates)} dates for {len(data)} fields")
+
+        for window in self.windows:
+            keys = window_keys(dates, window, self.seasons)
+            for key in pd.unique(keys):
+                if key:
+                    accumulator = self.accumulators.setdefault(key, WelfordAccumulator(self.shape))
+                    accumulator.add(data[keys == key])
+
+    # Function to merge the accumulators of another engine (e.g. from another worker)
+    def merge(self, other):
+        for key, accumulator in other.accumulators.items():
+            if key in self.accumulators:
+                self.accumulators[key].merge(accumulator)
+            else:
+                self.accumulators[key] = accumulator
+
+    # Function to write one NetCDF file per window key with mean, std and valid count
+    def write(self, output_dir, lat, lon, var_name, prefix, units="mol m-2"):
+        os.makedirs(output_dir, exist_ok=True)
+        paths = []
+        for key in sorted(self.accumulators):
+            mean, std, count = self.accumulators[key].result()
+            path = os.path.join(output_dir, f"{prefix}_{key}.nc")
+            with Dataset(path, 'w', format='NETCDF4') as ds_out:
+                ds_out.createDimension('x', len(lon))
+                ds_out.createDimension('y', len(lat))
+
+                x_out = ds_out.createVariable('x', 'f4', ('x',))
+                y_out = ds_out.createVariable('y', 'f4', ('y',))
+                x_out.standard_name, x_out.units, x_out.long_name = "longitude", "degrees_east", "Longitude"
+                y_out.standard_name, y_out.units, y_out.long_name = "latitude", "degrees_north", "Latitude"
+                x_out[:] = lon
+                y_out[:] = lat
+
+                for name, values, dtype, long_name in (
+                    ('mean', mean, 'f4', f"Mean {var_name}"),
+                    ('std', std, 'f4', f"Standard deviation of {var_name}"),
+                    ('count', count, 'i4', "Number of valid values"),
+                ):
+                    out = ds_out.createVariable(f"{var_name}_{name}", dtype, ('y', 'x'),
+                                                fill_value=np.nan if dtype == 'f4' else None)
+                    out.units = units if name != 'count' else "1"
+                    out.long_name = long_name
+                    out[:] = values
+
+                ds_out.window = key
+                ds_out.seasons = self.seasons
+            paths.append(path)
+        return paths
@@ -0,0 +1,145 @@
+import os
+import re
+import numpy as np
+import pandas as pd
+import netCDF4 as nc
+from parallel_months import atomic_output
+
+# Number of set bits of every byte value (popcount lookup table)
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype='u1')
+
+# One bit per day of the year, packed (np.packbits order) into 46 bytes
+DAY_BYTES = 46
+
+# Per-pixel data-coverage index of one gas: for every year, a (y, x, DAY_BYTES) array with
+# one bit per (pixel, day) set where the pixel has a valid value, plus the days that were indexed.
+# Queries only touch the bits, never the data arrays
+class CoverageIndex:
+
+    def __init__(self, index_dir, gas):
+        self.dir = os.path.join(index_dir, gas)
+        self.gas = gas
+        self._loaded = {}
+
+    def path(self, year):
+        return os.path.join(self.dir, f"{self.gas}_{year}.npz")
+
+    # Function to (re)build the index from daily NetCDF cubes (t in days since 1990-01-01).
+    # Valid values are those >= min_value, as in dataframes_selected_sites.py; with
+    # min_value=None every value that is neither masked nor NaN (or infinite) is valid
+    def build(self, files, var_name=None, min_value=0.0):
+        var_name = var_name or self.gas
+        years = {}
+        for file in sorted(files):
+            with nc.Dataset(file, 'r') as ds:
+                lat = np.asarray(ds.variables['y'][:])
+                lon = np.asarray(ds.variables['x'][:])
+                dates = pd.to_datetime('1990-01-01') + pd.to_timedelta(np.asarray(ds.variables['t'][:]), unit='D')
+                variable = ds.variables[var_name]
+
+                for i, date in enumerate(dates):
+                    if date.year not in years:
+                        years[date.year] = {
+                            'bits': np.zeros((len(lat), len(lon), DAY_BYTES), dtype='u1'),
+                            'indexed': np.zeros(DAY_BYTES, dtype='u1'), 'lat': lat, 'lon': lon,
+                        }
+                    entry = years[date.year]
+                    if entry['bits'].shape[:2] != (len(lat), len(lon)):
+                        raise ValueError(f"{file} does not share the grid of the other {date.year} files")
+
+                    # Valid = neither masked nor NaN, and at least min_value
+                    values = np.ma.filled(np.ma.asarray(variable[i], dtype='f8'), np.nan)
+                    with np.errstate(invalid='ignore'):
+                        valid = np.isfinite(values) if min_value is None else values >= min_value
+                    byte, bit = divmod(date.dayofyear - 1, 8)
+                    mask = np.uint8(0x80 >> bit)
+                    entry['bits'][..., byte] |= valid.astype('u1') * mask
+                    entry['indexed'][byte] |= mask
+
+        os.makedirs(self.dir, exist_ok=True)
+        for year, entry in years.items():
+            with atomic_output(self.path(year)) as tmp_path, open(tmp_path, 'wb') as f:
+                np.savez_compressed(f, **entry)
+            self._loaded.pop(year, None)
+        return sorted(years)
+
+    # Function to list the years present in the index
+    def years(self):
+        if not os.path.isdir(self.dir):
+            return []
+        pattern = re.compile(rf"{re.escape(self.gas)}_(\d{{4}})\.npz$")
+        return sorted(int(m.group(1)) for m in map(pattern.match, os.listdir(self.dir)) if m)
+
+    # Function to load the bits of one year (kept in memory once loaded)
+    def load(self, year):
+        if year not in self._loaded:
+            with np.load(self.path(year)) as data:
+                self._loaded[year] = {key: data[key] for key in data.files}
+        return self._loaded[year]
+
+    # Function to select the packed rows of some pixels: a boolean (y, x) mask, flat pixel
+    # indices, or None for the whole grid
+    def _pixel_bits(self, year, pixels=None):
+        bits = self.load(year)['bits'].reshape(-1, DAY_BYTES)
+        if pixels is None:
+            return bits
+        pixels = np.asarray(pixels)
+        if pixels.dtype == bool:
+            pixels = np.flatnonzero(pixels.ravel())
+        return bits[pixels]
+
+    # Function to count the valid days of every pixel in a year, as a (y, x) map
+    def pixel_counts(self, year):
+        return POPCOUNT[self.load(year)['bits']].sum(axis=-1, dtype='i4')
+
+    # Function to get, for each day of a year, whether any of the given pixels has data
+    def day_mask(self, year, pixels=None):
+        days = pd.Timestamp(year=year, month=12, day=31).dayofyear
+        any_valid = np.bitwise_or.reduce(self._pixel_bits(year, pixels), axis=0)
+        return np.unpackbits(any_valid)[:days].astype(bool)
+
+    # Function to list the dates of a year with data in any of the given pixels
+    def valid_dates(self, year, pixels=None):
+        return pd.Timestamp(year=year, month=1, day=1) + pd.to_timedelta(
+            np.flatnonzero(self.day_mask(year, pixels)), unit='D')
+
+    # Function to count the days of a year that were indexed (i.e. had a file)
+    def indexed_days(self, year):
+        return int(POPCOUNT[self.load(year)['indexed']].sum())
+
+    # Function to count the valid days of each site of a sparse (site x pixel) membership
+    # matrix (see site_catalog.py): a day counts when any pixel of the site has data
+    def site_counts(self, year, weights):
+        bits = self._pixel_bits(year)
+        counts = np.zeros(weights.shape[0], dtype='i4')
+        for i in range(weights.shape[0]):
+            pixels = weights.indices[weights.indptr[i]:weights.indptr[i + 1]]
+            if len(pixels):
+                counts[i] = POPCOUNT[np.bitwise_or.reduce(bits[pixels], axis=0)].sum()
+        return counts
+
+    # Function to build a coverage map over several years: valid days and the fraction of
+    # indexed days with data for each pixel
+    def coverage_map(self, years=None):
+        years = self.years() if years is None else years
+        valid = sum(self.pixel_counts(year) for year in years)
+        indexed = sum(self.indexed_days(year) for year in years)
+        return valid, valid / max(indexed, 1)
+
+
+if __name__ == "__main__":
+    # Folders with the daily TROPOMI cubes of each gas, and where the index is stored
+    gas_dirs = {
+        'HCHO': 'D:/Data/SP/HCHO',
+        'NO2': 'D:/Data/SP/NO2',
+        'O3': 'D:/Data/SP/O3',
+        'SO2': 'D:/Data/SP/SO2',
+        'CO': 'D:/Data/SP/CO',
+    }
+    index_dir = 'D:/Data/SP/COVERAGE_INDEX'
+
+    for gas, folder in gas_dirs.items():
+        index = CoverageIndex(index_dir, gas)
+        files = [os.path.join(folder, f) for f in os.listdir(folder) if f.endswith('.nc')]
+        for year in index.build(files):
+            print(f"{gas} {year}: {index.day_mask(year).sum()} days with data out of {index.indexed_days(year)} indexed")
@@ -0,0 +1,52 @@
+import os
+import glob
+import json
+import hashlib
+import pandas as pd
+from file_catalog import file_fingerprint
+from parallel_months import atomic_output
+
+# Sidecars are Feather files when pyarrow is installed, pickled DataFrames otherwise
+try:
+    import pyarrow  # noqa: F401
+    SIDECAR_FORMAT = 'feather'
+except ImportError:
+    SIDECAR_FORMAT = 'pkl'
+
+# Function to key a sidecar on the CSV (path, size, mtime) and on the options it was parsed with
+def sidecar_key(path, options):
+    key = f"{file_fingerprint(path)}|{json.dumps(options, sort_keys=True, default=str)}"
+    return hashlib.sha1(key.encode()).hexdigest()[:12]
+
+# Function to write a sidecar in the given format
+def write_sidecar(df, sidecar, fmt):
+    with atomic_output(sidecar) as tmp_path:
+        if fmt == 'feather':
+            df.to_feather(tmp_path)
+        else:
+            df.to_pickle(tmp_path, compression=None)
+
+# Function to read a CSV through a typed binary sidecar stored next to it: the CSV is parsed
+# (with the given pd.read_csv options) only when it or the options changed since the last load
+def read_csv_cached(path, **options):
+    key = sidecar_key(path, options)
+    for fmt in dict.fromkeys((SIDECAR_FORMAT, 'pkl')):
+        sidecar = f"{path}.{key}.{fmt}"
+        if os.path.exists(sidecar):
+            return pd.read_feather(sidecar) if fmt == 'feather' else pd.read_pickle(sidecar)
+
+    df = pd.read_csv(path, **options)
+
+    # Replace any outdated sidecar of this CSV; a read-only folder just means no caching
+    try:
+        for fmt in ('feather', 'pkl'):
+            for old in glob.glob(f"{glob.escape(path)}.*.{fmt}"):
+                os.remove(old)
+        try:
+            write_sidecar(df, f"{path}.{key}.{SIDECAR_FORMAT}", SIDECAR_FORMAT)
+        except (ValueError, TypeError):
+            # Feather cannot store some columns (e.g. mixed-type objects); pickle can
+            write_sidecar(df, f"{path}.{key}.pkl", 'pkl')
+    except (OSError, ValueError, TypeError):
+        pass
+    return df
@@ -2,69 +2,135 @@ import pandas as pd
 import numpy as np
 import datetime
 import os
-from scipy.interpolate import griddata
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from netCDF4 import Dataset
+from regridding import Regridder
+from parallel_months import atomic_output
 
-# Load CSV files
-files = []
-directory = 'D:/Results/CSV_Files/HCHO_SP'
-files.extend([os.path.join(directory, name) for name in os.listdir(directory) if name.endswith('.csv')])
+# Output grid: 'native' pivots the means onto the regular source lattice (no interpolation),
+# 'interpolate' interpolates them linearly onto a linspace grid of interp_shape (lat, lon)
+# and 'auto' uses 'native' whenever the source points form a regular lattice
+grid_mode = 'auto'
+interp_shape = (167, 176)
 
-for file in files:
+# Number of worker processes (1 = serial)
+workers = 1
 
+# Function to detect a regular 1-D lattice from coordinate values: returns the full axis
+# (including rows/columns with no data) or None if the values are not evenly spaced
+def lattice_axis(values, rtol=1e-3):
+    axis = np.unique(np.asarray(values, dtype='f8'))
+    if len(axis) < 2:
+        return axis
+    step = np.diff(axis).min()
+    multiples = np.diff(axis) / step
+    if not np.allclose(multiples, np.rint(multiples), rtol=0, atol=rtol):
+        return None
+    n = int(np.rint((axis[-1] - axis[0]) / step)) + 1
+    return np.linspace(axis[0], axis[-1], n)
+
+# Function to place values given at lattice coordinates into a 2-D (lat, lon) array
+def pivot_to_lattice(values, x, y, lon_axis, lat_axis):
+    grid = np.full((len(lat_axis), len(lon_axis)), np.nan)
+    lon_step = lon_axis[1] - lon_axis[0] if len(lon_axis) > 1 else 1.0
+    lat_step = lat_axis[1] - lat_axis[0] if len(lat_axis) > 1 else 1.0
+    ix = np.rint((np.asarray(x) - lon_axis[0]) / lon_step).astype(int)
+    iy = np.rint((np.asarray(y) - lat_axis[0]) / lat_step).astype(int)
+    grid[iy, ix] = values
+    return grid
+
+# Function to convert one CSV file into a NetCDF file of its mean HCHO field
+def csv_to_netcdf(file, out_dir, grid_mode='auto', interp_shape=(167, 176)):
     df = pd.read_csv(file)
-    
+
     # Extract the first date from the CSV file
     start_date = datetime.datetime.strptime(df['t'].min(), "%Y-%m-%d")
     start_date_str = start_date.strftime("%d/%m/%Y")
-    
+
     # Extract the last date from the CSV file
     end_date = datetime.datetime.strptime(df['t'].max(), "%Y-%m-%d")
     end_date_str = end_date.strftime("%d/%m/%Y")
-    
+
     # Filter the data for the specified date range
     data_in_range = df[(df['t'] >= start_date.strftime("%Y-%m-%d")) & (df['t'] <= end_date.strftime("%Y-%m-%d"))]
-    
+
     # Remove rows with NaN values in the 'HCHO' column
     data_in_range = data_in_range.dropna(subset=['HCHO'])
-    
+
     # Convert HCHO data from mol/m² to molecules/cm² (example placeholder, commented)
     ##data_in_range['HCHO'] /= 4.4615E-04
-    
+
     # Calculate monthly averages grouped by latitude and longitude
     monthly_means = data_in_range.groupby(['x', 'y'])['HCHO'].mean().reset_index()
-        
-    # Create a regular grid for interpolation
-    lon_min, lon_max = monthly_means['x'].min(), monthly_means['x'].max()
-    lat_min, lat_max = monthly_means['y'].min(), monthly_means['y'].max()
-    
-    lon_grid, lat_grid = np.meshgrid(np.linspace(lon_min, lon_max, 176), np.linspace(lat_min, lat_max, 167))
-    
-    points = np.array(monthly_means[['x', 'y']])
-    values = np.array(monthly_means['HCHO'])
-    
-    # Interpolate HCHO data onto the grid
-    hcho_interp = griddata(points, values, (lon_grid, lat_grid), method='linear')
-    
+
+    # Detect the regular lattice of the source points (all rows, including NaN pixels)
+    lon_axis, lat_axis = lattice_axis(df['x']), lattice_axis(df['y'])
+    mode = grid_mode
+    if mode == 'auto':
+        mode = 'native' if lon_axis is not None and lat_axis is not None else 'interpolate'
+
+    if mode == 'native':
+        if lon_axis is None or lat_axis is None:
+            raise ValueError(f"{file} is not on a regular lat/lon lattice")
+        hcho_grid = pivot_to_lattice(monthly_means['HCHO'], monthly_means['x'], monthly_means['y'],
+                                     lon_axis, lat_axis)
+    elif mode == 'interpolate':
+        # Create a regular grid for interpolation
+        lon_min, lon_max = monthly_means['x'].min(), monthly_means['x'].max()
+        lat_min, lat_max = monthly_means['y'].min(), monthly_means['y'].max()
+        lat_axis = np.linspace(lat_min, lat_max, interp_shape[0])
+        lon_axis = np.linspace(lon_min, lon_max, interp_shape[1])
+
+        # Linear interpolation of the scattered means (same result as griddata). Each CSV has its
+        # own set of points, so the weights are built for this file only and not cached on disk or
+        # kept in memory. Points are passed as (n, 1) arrays so they are not expanded into a mesh
+        points_lat = monthly_means['y'].to_numpy()[:, np.newaxis]
+        points_lon = monthly_means['x'].to_numpy()[:, np.newaxis]
+        regridder = Regridder(points_lat, points_lon, lat_axis, lon_axis)
+        hcho_grid = regridder.regrid(monthly_means['HCHO'].to_numpy()[:, np.newaxis])
+    else:
+        raise ValueError(f"Unknown grid mode: {grid_mode}")
+
     # Extract the CSV file name without extension
     file_name = os.path.splitext(os.path.basename(file))[0]
-    
-    # Save interpolated data to a NetCDF file
-    with Dataset(f'D:/Results/Monthly_Means/NetCDF_Files/HCHO/{file_name}.nc', 'w') as ncfile:
-        
+
+    # Save the gridded data to a NetCDF file
+    out_file = os.path.join(out_dir, f'{file_name}.nc')
+    with atomic_output(out_file) as tmp_file, Dataset(tmp_file, 'w') as ncfile:
+
         # Create dimensions
-        ncfile.createDimension('lon', len(lon_grid[0]))
-        ncfile.createDimension('lat', len(lat_grid))
-        
+        ncfile.createDimension('lon', len(lon_axis))
+        ncfile.createDimension('lat', len(lat_axis))
+
         # Create variables
         lon_var = ncfile.createVariable('longitude', 'f4', ('lon',))
         lat_var = ncfile.createVariable('latitude', 'f4', ('lat',))
         hcho_var = ncfile.createVariable('HCHO', 'f4', ('lat', 'lon'))
-        
+
         # Assign variable values
-        lon_var[:] = np.linspace(lon_min, lon_max, len(lon_grid[0]))
-        lat_var[:] = np.linspace(lat_min, lat_max, len(lat_grid))
-        hcho_var[:, :] = hcho_interp
-    
+        lon_var[:] = lon_axis
+        lat_var[:] = lat_axis
+        hcho_var[:, :] = hcho_grid
+
         # Add history attribute
-        ncfile.history = f'Monthly mean HCHO data for {start_date_str} to {end_date_str}'
\ No newline at end of file
+        ncfile.history = f'Monthly mean HCHO data for {start_date_str} to {end_date_str}'
+    return out_file
+
+
+if __name__ == "__main__":
+    # Load CSV files
+    files = []
+    directory = 'D:/Results/CSV_Files/HCHO_SP'
+    files.extend([os.path.join(directory, name) for name in os.listdir(directory) if name.endswith('.csv')])
+    out_dir = 'D:/Results/Monthly_Means/NetCDF_Files/HCHO'
+
+    args = (out_dir, grid_mode, interp_shape)
+    if workers <= 1:
+        for file in files:
+            csv_to_netcdf(file, *args)
+    else:
+        # Each CSV is independent, so they are converted in a process pool
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+            list(pool.map(csv_to_netcdf, files, *[[arg] * len(files) for arg in args]))
@@ -2,57 +2,158 @@ import netCDF4 as nc
 import pandas as pd
 import numpy as np
 import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from site_catalog import get_membership, crop_to_window, load_geojson_sites, sites_hash
+from file_catalog import file_content_hash
+from parallel_months import atomic_output
+
+# Function to process a NetCDF file once for all sites: returns the days and, for every
+# (day, site), the sum and count of valid (>= 0) values
+def process_file(file_path, sites, cache_dir=None, var_name="HCHO"):
+    with nc.Dataset(file_path, 'r') as dataset:
+        x_data = dataset.variables["x"][:]
+        y_data = dataset.variables["y"][:]
+        t_data = np.asarray(dataset.variables["t"][:])
+
+        # Sparse site x pixel membership of this grid (cached by grid hash), cropped to the
+        # window holding all sites so only that hyperslab is read
+        weights = get_membership(sites, y_data, x_data, cache_dir)
+        ys, xs, weights = crop_to_window(weights, (len(y_data), len(x_data)))
+        if weights.shape[1] == 0:
+            return t_data, np.zeros((len(t_data), len(sites))), np.zeros((len(t_data), len(sites)))
+
+        # Read the window with fill values as NaN
+        data = np.ma.filled(dataset.variables[var_name][:, ys, xs].astype('f8'), np.nan)
+
+    # Reduce all sites and time steps with sparse products, ignoring negative values
+    data = data.reshape(len(t_data), -1)
+    valid = data >= 0
+    sums = (weights @ np.where(valid, data, 0.0).T).T
+    counts = (weights @ valid.T.astype('f8')).T
+    return t_data, sums, counts
+
+
+# Function to turn one file into its per-(day, site) partials: a table indexed by day
+# with a sum and a count column per site. Partials of different files merge exactly
+def file_partials(file_path, sites, cache_dir=None):
+    t_data, sums, counts = process_file(file_path, sites, cache_dir)
+    names = [site['name'] for site in sites]
+    return pd.DataFrame(
+        np.hstack([sums, counts]),
+        index=pd.Index(t_data, name='day'),
+        columns=[f'{name}_sum' for name in names] + [f'{name}_count' for name in names]
+    )
 
-# Function to process a NetCDF file and return a dataframe
-def process_file(file_path, lat_range, lon_range):
-    # Open the NetCDF file
-    dataset = nc.Dataset(file_path, 'r')
-
-    # Extract HCHO and coordinates
-    hcho = dataset.variables["HCHO"][:]
-    x_data = dataset.variables["x"][:]
-    y_data = dataset.variables["y"][:]
-    t_data = dataset.variables["t"][:]
-
-    # Create the dataframe
-    hcho_df = pd.DataFrame({
-        'hcho': hcho.flatten(),
-        'lon': x_data.tolist() * len(y_data) * len(t_data),
-        'lat': np.tile(y_data.repeat(len(x_data)), len(t_data)),
-        'day': t_data.repeat(len(x_data) * len(y_data)),
-    })
-
-    # Filter the region of interest
-    hcho_df = hcho_df[
-        (hcho_df['lon'] >= lon_range[0]) & (hcho_df['lon'] <= lon_range[1]) &
-        (hcho_df['lat'] >= lat_range[0]) & (hcho_df['lat'] <= lat_range[1])
-    ]
-
-    # Close the NetCDF file
-    dataset.close()
-
-    return hcho_df
+# Function to compute the partials of every file, serially (workers <= 1) or in a process pool.
+# Results come back in file order, so the merged means do not depend on the number of workers
+def map_files(files, sites, workers=1, cache_dir=None):
+    if workers <= 1:
+        return [file_partials(file, sites, cache_dir) for file in files]
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+        return list(pool.map(file_partials, files, [sites] * len(files), [cache_dir] * len(files), chunksize=4))
+
+# Function to merge partials (a day may appear in more than one file) into per-day totals
+def merge_partials(partials):
+    return pd.concat(partials).groupby(level='day').sum()
+
+# Function to turn per-day totals into the wide daily-mean table, one column per site
+def daily_means(totals, site_names):
+    sums = totals[[f'{name}_sum' for name in site_names]].to_numpy()
+    counts = totals[[f'{name}_count' for name in site_names]].to_numpy()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.where(counts > 0, sums / counts, np.nan)
+
+    # Sums are kept in double precision; the means are written as float32 like the input columns
+    start_date = pd.to_datetime('1990-01-01')
+    result = pd.DataFrame(means.astype('f4'), columns=site_names)
+    result.insert(0, 'day', start_date + pd.to_timedelta(totals.index.to_numpy(), unit='D'))
+
+    # Keep only days with data in at least one site, sorted by day
+    return result[counts.sum(axis=1) > 0].sort_values(by='day').reset_index(drop=True)
+
+
+# Function to load the record of processed input files (path, size, mtime, content hash)
+# and their stored partials. Everything is recomputed if the site definitions changed
+def load_state(state_dir, sites):
+    manifest_path = os.path.join(state_dir, "files.csv")
+    partials_path = os.path.join(state_dir, "partials.csv")
+    empty = pd.DataFrame(columns=['path', 'size', 'mtime_ns', 'sha1', 'sites'])
+    if not (os.path.exists(manifest_path) and os.path.exists(partials_path)):
+        return empty, None
+    manifest = pd.read_csv(manifest_path)
+    if (manifest['sites'] != sites_hash(sites)).any():
+        return empty, None
+    partials = pd.read_csv(partials_path, index_col='day', float_precision='round_trip')
+    return manifest, partials
+
+# Function to compare the input files with the manifest: returns the updated manifest and
+# the files that are new or whose contents changed (touched but identical files are skipped)
+def changed_files(files, manifest, sites):
+    known = manifest.set_index('path')
+    records, todo = [], []
+    for path in files:
+        stat = os.stat(path)
+        record = {'path': path, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sites': sites_hash(sites)}
+        if path in known.index and (known.at[path, 'size'], known.at[path, 'mtime_ns']) == (stat.st_size, stat.st_mtime_ns):
+            record['sha1'] = known.at[path, 'sha1']
+        else:
+            record['sha1'] = file_content_hash(path)
+            if path not in known.index or known.at[path, 'sha1'] != record['sha1']:
+                todo.append(path)
+        records.append(record)
+    return pd.DataFrame(records, columns=['path', 'size', 'mtime_ns', 'sha1', 'sites']), todo
+
+# Function to save the manifest and the partials of every input file
+def save_state(state_dir, manifest, partials):
+    os.makedirs(state_dir, exist_ok=True)
+    with atomic_output(os.path.join(state_dir, "partials.csv")) as tmp_path:
+        partials.to_csv(tmp_path)
+    with atomic_output(os.path.join(state_dir, "files.csv")) as tmp_path:
+        manifest.to_csv(tmp_path, index=False)
+
+# Function to write the daily table as CSV or, for a .parquet path, as Parquet
+def write_table(table, path):
+    with atomic_output(path) as tmp_path:
+        if path.endswith('.parquet'):
+            table.to_parquet(tmp_path, index=False)
+        else:
+            table.to_csv(tmp_path, index=False)
+
+
+# Sites of interest: latitude and longitude boxes (points with a radius and polygons are
+# also accepted, see site_catalog.py)
+sites = [
+    {'name': "MASP", 'lat_range': (-24.08, -23.38), 'lon_range': (-46.88, -46.18)},
+    {'name': "COUNTRYSIDE", 'lat_range': (-21.93, -21.23), 'lon_range': (-49.63, -48.93)},
+    {'name': "PETAR", 'lat_range': (-24.60, -23.90), 'lon_range': (-48.73, -48.03)},
+    {'name': "PARQUE_DOM_PEDRO_II", 'lat_range': (-23.59, -23.49), 'lon_range': (-46.67, -46.57)},
+    {'name': "SANTOS", 'lat_range': (-24.03, -23.93), 'lon_range': (-46.35, -46.25)},
+    {'name': "NOVO_HORIZONTE", 'lat_range': (-21.52, -21.42), 'lon_range': (-49.26, -49.16)},
+    {'name': "MORRO_GRANDE", 'lat_range': (-23.78, -23.68), 'lon_range': (-47.01, -46.91)},
+    {'name': "CENTRAL_PETAR", 'lat_range': (-24.41, -24.31), 'lon_range': (-48.48, -48.38)},
+    {'name': "SP_AGRICULTURE", 'lat_range': (-21.77, -21.67), 'lon_range': (-49.46, -49.36)}
+]
 
+# Optional GeoJSON file with more sites (e.g. stations or municipalities)
+sites_geojson = None
+if sites_geojson:
+    sites += load_geojson_sites(sites_geojson)
+site_names = [site['name'] for site in sites]
 
-# List of regions of interest (latitude and longitude bounds)
-regions = [
-    {'lat_range': (-24.08, -23.38), 'lon_range': (-46.88, -46.18)},  # MASP
-    {'lat_range': (-21.93, -21.23), 'lon_range': (-49.63, -48.93)},  # COUNTRYSIDE
-    {'lat_range': (-24.60, -23.90), 'lon_range': (-48.73, -48.03)},  # PETAR
-    {'lat_range': (-23.59, -23.49), 'lon_range': (-46.67, -46.57)},  # PARQUE_DOM_PEDRO_II
-    {'lat_range': (-24.03, -23.93), 'lon_range': (-46.35, -46.25)},  # SANTOS
-    {'lat_range': (-21.52, -21.42), 'lon_range': (-49.26, -49.16)},  # NOVO_HORIZONTE
-    {'lat_range': (-23.78, -23.68), 'lon_range': (-47.01, -46.91)},  # MORRO_GRANDE
-    {'lat_range': (-24.41, -24.31), 'lon_range': (-48.48, -48.38)},  # CENTRAL_PETAR
-    {'lat_range': (-21.77, -21.67), 'lon_range': (-49.46, -49.36)}   # SP_AGRICULTURE
-]
+# Folder where the pixel-membership matrices of each grid are cached
+membership_dir = "D:/OpenEO_Results/Dataframes/SP/site_weights"
 
+# Number of worker processes (1 = serial)
+workers = 1
 
-# Process each region and calculate daily HCHO averages
-daily_mean_by_region = []
+# Incremental mode: only new or changed input files are read; the partials of the other
+# files are reused from the state folder
+incremental = True
+state_dir = "D:/OpenEO_Results/Dataframes/SP/SP_HCHO_state"
 
-for region in regions:
-    combined_df = pd.DataFrame()
+if __name__ == "__main__":
     directories = [
         "D:/Data/SP/HCHO"  # Folder with HCHO NetCDF files
     ]
@@ -60,54 +161,35 @@ for region in regions:
     files = []
     for directory in directories:
         files.extend([os.path.join(directory, f) for f in os.listdir(directory) if f.endswith('.nc')])
-    
-    for file in files:
-        temp_df = process_file(file, lat_range=region['lat_range'], lon_range=region['lon_range'])
-        combined_df = pd.concat([combined_df, temp_df], ignore_index=True)
-
-    # Ignore negative values when calculating the mean
-    combined_df = combined_df[combined_df['hcho'] >= 0]
-
-    if not combined_df.empty:
-        start_date = pd.to_datetime('1990-01-01')
-        combined_df['day'] = start_date + pd.to_timedelta(combined_df['day'], unit='D')
-        daily_mean = combined_df.groupby('day')['hcho'].mean().reset_index()
-        daily_mean_by_region.append(daily_mean)
-
-
-# Define region names
-region_names = [
-    "MASP", "COUNTRYSIDE", "PETAR", "PARQUE_DOM_PEDRO_II", "SANTOS",
-    "NOVO_HORIZONTE", "MORRO_GRANDE", "CENTRAL_PETAR", "SP_AGRICULTURE"
-]
-
-
-# Combine results into a single dataframe
-final_result = daily_mean_by_region[0]
-for i in range(1, len(daily_mean_by_region)):
-    final_result = pd.merge(
-        final_result,
-        daily_mean_by_region[i],
-        on='day',
-        suffixes=('', f'_{region_names[i]}'),
-        how='outer'
-    )
-
-# Rename columns to indicate regions
-final_result.columns = ['day'] + region_names
-
-# Sort dataframe by day
-final_result = final_result.sort_values(by='day')
-
-# Identify first and last date
-start_date = final_result['day'].iloc[0]
-end_date = final_result['day'].iloc[-1]
-
-# Create dataframe with all dates in the interval
-date_range_df = pd.DataFrame({'day': pd.date_range(start=start_date, end=end_date)})
-
-# Merge interval dataframe with final results
-final_result = pd.merge(date_range_df, final_result, on='day', how='outer')
-
-# Export the dataframe to CSV
-final_result.to_csv("D:/OpenEO_Results/Dataframes/SP/SP_HCHO.csv", index=False)
+    files.sort()
+
+    # Map: per-file partial sums and counts. In incremental mode only new or changed files
+    # are read, and the partials of the other files come from the state folder
+    stored, todo = None, files
+    if incremental:
+        manifest, stored = load_state(state_dir, sites)
+        manifest, todo = changed_files(files, manifest, sites)
+    print(f"Processing {len(todo)} of {len(files)} files")
+
+    partials = [p.assign(file=f) for f, p in zip(todo, map_files(todo, sites, workers, membership_dir))]
+    if stored is not None:
+        partials.append(stored[stored['file'].isin(set(files) - set(todo))])
+    partials = pd.concat(partials).sort_values('file', kind='stable')
+    if incremental:
+        save_state(state_dir, manifest, partials)
+
+    # Reduce: exact merge (always in file order) into daily means
+    final_result = daily_means(merge_partials([partials.drop(columns='file')]), site_names)
+
+    # Identify first and last date
+    start_date = final_result['day'].iloc[0]
+    end_date = final_result['day'].iloc[-1]
+
+    # Create dataframe with all dates in the interval
+    date_range_df = pd.DataFrame({'day': pd.date_range(start=start_date, end=end_date)})
+
+    # Merge interval dataframe with final results
+    final_result = pd.merge(date_range_df, final_result, on='day', how='outer')
+
+    # Export the dataframe to CSV
+    write_table(final_result, "D:/OpenEO_Results/Dataframes/SP/SP_HCHO.csv")
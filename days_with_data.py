@@ -1,8 +1,8 @@
-import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib import font_manager
 import os
+from csv_cache import read_csv_cached
 
 # Font configuration
 font_path = 'D:/SF-Pro-Display-Regular.ttf'
@@ -37,7 +37,7 @@ legend_labels = []
 
 # Loop through each CSV file
 for idx, (csv_path, label) in enumerate(zip(csv_files, pollutant_labels)):
-    df = pd.read_csv(csv_path, parse_dates=['day'])
+    df = read_csv_cached(csv_path, parse_dates=['day'])
 
     # Create 'year' column if not present
     if 'year' not in df.columns:
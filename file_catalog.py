@@ -0,0 +1,169 @@
+import os
+import re
+import json
+import sqlite3
+import hashlib
+import numpy as np
+import netCDF4 as nc
+from regridding import grid_hash
+
+# Date patterns in file names: MERRA-2 daily granules (...20190101.SUB.nc)
+# and TROPOMI monthly files (FR_O3_2019_01.nc)
+DAILY_PATTERN = re.compile(r'(\d{4})(\d{2})(\d{2})(?:\.SUB)?\.nc$')
+MONTHLY_PATTERN = re.compile(r'_(\d{4})_(\d{2})\.nc$')
+
+# Function to turn 'YYYYMMDD', 'YYYY-MM-DD' or a datetime64 into 'YYYY-MM-DD'
+def normalize_date(date):
+    if isinstance(date, str) and len(date) == 8 and date.isdigit():
+        return f"{date[:4]}-{date[4:6]}-{date[6:]}"
+    return np.datetime_as_string(np.datetime64(date, 'D'), unit='D')
+
+# Function to fingerprint a file from its path, size and modification time; it changes
+# whenever the file is rewritten, without reading its contents
+def file_fingerprint(path):
+    stat = os.stat(path)
+    key = f"{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}"
+    return hashlib.sha1(key.encode()).hexdigest()
+
+# Function to hash the contents of a file, read in blocks; used to tell a rewritten file
+# from one that was only touched
+def file_content_hash(path, block_size=1 << 20):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+# Function to read grid, shape and time-range metadata from a NetCDF file
+def read_metadata(path, variable):
+    with nc.Dataset(path) as ds:
+        lat_name = 'lat' if 'lat' in ds.variables else 'y'
+        lon_name = 'lon' if 'lon' in ds.variables else 'x'
+        grid = None
+        if lat_name in ds.variables and lon_name in ds.variables:
+            grid = grid_hash(ds.variables[lat_name][:], ds.variables[lon_name][:])
+
+        shape = list(ds.variables[variable].shape) if variable in ds.variables else None
+
+        time_start = time_end = None
+        time_name = 'time' if 'time' in ds.variables else ('t' if 't' in ds.variables else None)
+        if time_name is not None and len(ds.variables[time_name]) > 0:
+            time_var = ds.variables[time_name]
+            times = nc.num2date(time_var[[0, -1]], time_var.units,
+                                getattr(time_var, 'calendar', 'standard'))
+            time_start = times[0].strftime('%Y-%m-%dT%H:%M')
+            time_end = times[1].strftime('%Y-%m-%dT%H:%M')
+    return grid, shape, time_start, time_end
+
+# Function to get the date range covered by a file from its name (or its time axis)
+def date_range_of(name, time_start, time_end):
+    match = DAILY_PATTERN.search(name)
+    if match:
+        date = '-'.join(match.groups())
+        return date, date
+    if time_start is not None:
+        return time_start[:10], time_end[:10]
+    match = MONTHLY_PATTERN.search(name)
+    if match:
+        month = np.datetime64(f"{match.group(1)}-{match.group(2)}", 'M')
+        return str(month.astype('datetime64[D]')), str((month + 1).astype('datetime64[D]') - 1)
+    return None, None
+
+# Persistent SQLite index mapping (product, variable, date, time) to file paths
+class FileCatalog:
+
+    def __init__(self, db_path):
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.db = sqlite3.connect(db_path)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS folders (
+                folder TEXT, product TEXT, variable TEXT, mtime REAL,
+                PRIMARY KEY (folder, product, variable)
+            );
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY, folder TEXT, product TEXT, variable TEXT,
+                date_start TEXT, date_end TEXT, time_start TEXT, time_end TEXT,
+                grid TEXT, shape TEXT, size INTEGER, mtime REAL
+            );
+            CREATE INDEX IF NOT EXISTS files_lookup ON files (product, variable, date_start, date_end);
+        """)
+
+    # Function to (re)index a folder; only new or modified files (by size and mtime) are read again.
+    # A file rewritten in place does not change the folder's mtime, so skipping folders whose mtime
+    # is unchanged (trust_folder_mtime) is only safe for archives whose files are never rewritten
+    def refresh(self, folder, product, variable, suffix='.nc', force=False, trust_folder_mtime=False):
+        folder_mtime = os.stat(folder).st_mtime
+        row = self.db.execute(
+            "SELECT mtime FROM folders WHERE folder=? AND product=? AND variable=?",
+            (folder, product, variable)
+        ).fetchone()
+        if trust_folder_mtime and row is not None and row[0] == folder_mtime and not force:
+            return
+
+        known = {
+            path: (size, mtime) for path, size, mtime in self.db.execute(
+                "SELECT path, size, mtime FROM files WHERE folder=? AND product=? AND variable=?",
+                (folder, product, variable)
+            )
+        }
+
+        seen = set()
+        for entry in os.scandir(folder):
+            if not entry.is_file() or not entry.name.endswith(suffix):
+                continue
+            stat = entry.stat()
+            seen.add(entry.path)
+
+            # Only new or modified files are opened to read their metadata
+            if known.get(entry.path) == (stat.st_size, stat.st_mtime) and not force:
+                continue
+            grid, shape, time_start, time_end = read_metadata(entry.path, variable)
+            date_start, date_end = date_range_of(entry.name, time_start, time_end)
+            if date_start is None:
+                continue
+            self.db.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (entry.path, folder, product, variable, date_start, date_end, time_start, time_end,
+                 grid, json.dumps(shape), stat.st_size, stat.st_mtime)
+            )
+
+        # Drop files that disappeared from the folder
+        for path in set(known) - seen:
+            self.db.execute("DELETE FROM files WHERE path=?", (path,))
+
+        self.db.execute(
+            "INSERT OR REPLACE INTO folders VALUES (?, ?, ?, ?)",
+            (folder, product, variable, folder_mtime)
+        )
+        self.db.commit()
+
+    # Function to find the file covering a date (and optionally a start time 'HH:MM')
+    def find(self, product, variable, date, time=None):
+        date = normalize_date(date)
+        query = ("SELECT path FROM files WHERE product=? AND variable=? "
+                 "AND date_start<=? AND date_end>=?")
+        params = [product, variable, date, date]
+        if time is not None:
+            query += " AND time_start=?"
+            params.append(f"{date}T{time}")
+        row = self.db.execute(query + " ORDER BY time_start, path LIMIT 1", params).fetchone()
+        return row[0] if row is not None else None
+
+    # Function to list catalogued files of a product/variable overlapping a date range
+    def files(self, product, variable, start=None, end=None):
+        start = normalize_date(start) if start is not None else '0000-01-01'
+        end = normalize_date(end) if end is not None else '9999-12-31'
+        rows = self.db.execute(
+            "SELECT path, date_start, date_end, time_start, time_end, grid, shape FROM files "
+            "WHERE product=? AND variable=? AND date_end>=? AND date_start<=? "
+            "ORDER BY date_start, time_start, path",
+            (product, variable, start, end)
+        ).fetchall()
+        return [
+            {'path': r[0], 'date_start': r[1], 'date_end': r[2], 'time_start': r[3],
+             'time_end': r[4], 'grid': r[5], 'shape': json.loads(r[6])}
+            for r in rows
+        ]
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,186 @@
+import os
+import re
+import numpy as np
+import pandas as pd
+import netCDF4 as nc
+from bootstrap import bootstrap_samples, percentile_ci
+
+# Streaming histogram of ozone exceedances as a function of FNR (HCHO/NO2): for every day added
+# and every FNR bin, the number of valid (pixel or station) values and how many of them exceeded
+# the O3 threshold. Only these small per-day rows are kept, never the data itself
+class ExceedanceHistogram:
+
+    def __init__(self, edges, threshold):
+        self.edges = np.asarray(edges, dtype='f8')
+        self.threshold = threshold
+        self.dates = []
+        self.daily_totals = []
+        self.daily_exceedances = []
+
+    # Function to add the co-located HCHO, NO2 and O3 values of one day (arrays of any matching shape)
+    def add(self, hcho, no2, o3, date=None):
+        hcho, no2, o3 = (np.ma.filled(np.ma.asarray(v, dtype='f8'), np.nan).ravel() for v in (hcho, no2, o3))
+        valid = np.isfinite(hcho) & np.isfinite(no2) & np.isfinite(o3) & (no2 > 0)
+        n_bins = len(self.edges) - 1
+        bins = np.searchsorted(self.edges, hcho[valid] / no2[valid], side='right') - 1
+        inside = (bins >= 0) & (bins < n_bins)
+        bins = bins[inside]
+        self.dates.append(date)
+        self.daily_totals.append(np.bincount(bins, minlength=n_bins))
+        self.daily_exceedances.append(np.bincount(bins[o3[valid][inside] > self.threshold], minlength=n_bins))
+
+    def merge(self, other):
+        self.dates += other.dates
+        self.daily_totals += other.daily_totals
+        self.daily_exceedances += other.daily_exceedances
+
+    # Function to get the (days, bins) arrays of totals and exceedances
+    def counts(self):
+        n_bins = len(self.edges) - 1
+        totals = np.array(self.daily_totals, dtype='i8').reshape(-1, n_bins)
+        exceedances = np.array(self.daily_exceedances, dtype='i8').reshape(-1, n_bins)
+        return totals, exceedances
+
+    # Function to get the bin centres, exceedance probabilities and counts of bins with enough data
+    def probability(self, min_count=1):
+        totals, exceedances = (c.sum(axis=0) for c in self.counts())
+        centres = 0.5 * (self.edges[:-1] + self.edges[1:])
+        keep = totals >= min_count
+        return centres[keep], exceedances[keep] / totals[keep], totals[keep], exceedances[keep]
+
+    # Function to save the histograms; extra values (e.g. the fitted peak and its CI) are stored with them
+    def save(self, path, **extra):
+        totals, exceedances = self.counts()
+        np.savez_compressed(path, edges=self.edges, threshold=self.threshold, totals=totals,
+                            exceedances=exceedances, dates=np.array(self.dates, dtype='U10'), **extra)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            histogram = cls(data['edges'], float(data['threshold']))
+            histogram.dates = list(data['dates'])
+            histogram.daily_totals = list(data['totals'])
+            histogram.daily_exceedances = list(data['exceedances'])
+        return histogram
+
+# Function to locate the maximum of polynomials (coefficient columns of coef, highest degree first)
+# inside x_range; returns the x and y of each peak. The maximum is at an end of the range or at a
+# real root of the derivative, so those are the only candidates. The roots of all columns are the
+# eigenvalues of their companion matrices, found at once; the real part of every root inside the
+# range is a candidate, since extra points inside the range can never beat the true maximum
+def curve_peaks(coef, x_range):
+    coef = np.asarray(coef, dtype='f8').reshape(len(coef), -1)
+    degree, n_curves = len(coef) - 1, coef.shape[1]
+    candidates = [np.full(n_curves, float(x_range[0])), np.full(n_curves, float(x_range[1]))]
+
+    if degree >= 2:
+        deriv = coef[:-1] * np.arange(degree, 0, -1)[:, np.newaxis]
+        m = degree - 1
+        with np.errstate(divide='ignore', invalid='ignore'):
+            companion = np.zeros((n_curves, m, m))
+            companion[:, 0, :] = -(deriv[1:] / deriv[0]).T
+            companion[:, np.arange(1, m), np.arange(m - 1)] = 1.0
+        valid = np.isfinite(companion).all(axis=(1, 2))
+        roots = np.full((n_curves, m), np.nan)
+        roots[valid] = np.linalg.eigvals(companion[valid]).real
+        inside = (roots >= x_range[0]) & (roots <= x_range[1])
+        candidates += list(np.where(inside, roots, np.nan).T)
+
+    # Evaluate every candidate (Horner's rule) and keep the highest
+    x = np.array(candidates)
+    y = np.zeros_like(x)
+    for c in coef:
+        y = y * x + c
+    k = np.argmax(np.where(np.isnan(y), -np.inf, y), axis=0)
+    columns = np.arange(n_curves)
+    return x[k, columns], y[k, columns]
+
+# Function to estimate the peak FNR of the polynomial fit of exceedance probability, weighted by
+# the number of values per bin, with a bootstrap confidence interval from resampling the days
+# (in blocks of block_size consecutive days). Every resample's weighted fit is solved at once from
+# its resampled counts. Returns (x_peak, y_peak, ci_low, ci_high)
+def peak_with_ci(histogram, degree=3, min_count=1, n_boot=2000, block_size=1, ci=0.95, seed=0,
+                 max_chunk_mb=256):
+    totals, exceedances = histogram.counts()
+    centres = 0.5 * (histogram.edges[:-1] + histogram.edges[1:])
+    keep = totals.sum(axis=0) >= min_count
+    if keep.sum() <= degree:
+        raise ValueError(f"At least {degree + 1} FNR bins with {min_count} values are needed for the fit")
+    x, totals, exceedances = centres[keep], totals[:, keep], exceedances[:, keep]
+    x_range = (x.min(), x.max())
+
+    # Weighted least squares (weights = counts): the normal equations of a resample only need its
+    # summed totals and exceedances, since count * probability = exceedances
+    vander = np.vander(x, degree + 1)
+    outer = vander[:, :, np.newaxis] * vander[:, np.newaxis, :]
+
+    def peaks(w):
+        gram = np.tensordot(w @ totals, outer, axes=1)
+        rhs = (w @ exceedances) @ vander
+        coef = (np.linalg.pinv(gram) @ rhs[:, :, np.newaxis])[:, :, 0]
+        return curve_peaks(coef.T, x_range)[0]
+
+    coef = np.polyfit(x, exceedances.sum(axis=0) / totals.sum(axis=0), degree, w=np.sqrt(totals.sum(axis=0)))
+    x_peak, y_peak = (v[0] for v in curve_peaks(coef, x_range))
+    samples = bootstrap_samples(peaks, len(totals), n_boot, block_size, seed, max_chunk_mb)
+    low, high = percentile_ci(samples, ci)
+    return x_peak, y_peak, low, high
+
+
+if __name__ == "__main__":
+    # Daily monthly-file cubes (FR_<GAS>_YYYY_MM.nc) of each product, and their variable names
+    hcho_dir, hcho_var = 'D:/Data/SP/HCHO', 'HCHO'
+    no2_dir, no2_var = 'D:/Data/SP/NO2', 'NO2'
+    o3_dir, o3_var = 'D:/Data/SP/O3_SURFACE', 'O3'
+
+    # O3 exceedance threshold, in the units of the O3 variable, and the FNR bins
+    o3_threshold = 70.0
+    edges = np.arange(0.0, 6.0 + 1e-9, 0.1)
+    min_count = 100
+
+    # Bootstrap settings for the CI of the peak: resamples and block length in days
+    n_boot = 2000
+    block_size = 5
+
+    # Outputs: the probability curve read by fnr_x_prob_o3.py, and the per-day histograms with the
+    # peak and its CI
+    output_csv = 'D:/Data/SP/FNR/FNRxProbO3.csv'
+    output_npz = 'D:/Data/SP/FNR/FNRxProbO3_daily.npz'
+
+    # Function to index a folder's monthly files by (year, month)
+    def monthly_files(folder):
+        files = {}
+        for name in os.listdir(folder):
+            match = re.search(r'_(\d{4})_(\d{2})\.nc$', name)
+            if match:
+                files[(int(match.group(1)), int(match.group(2)))] = os.path.join(folder, name)
+        return files
+
+    hcho_files, no2_files, o3_files = monthly_files(hcho_dir), monthly_files(no2_dir), monthly_files(o3_dir)
+    histogram = ExceedanceHistogram(edges, o3_threshold)
+
+    # Stream the months present for all three products, one co-located day at a time
+    for key in sorted(set(hcho_files) & set(no2_files) & set(o3_files)):
+        with nc.Dataset(hcho_files[key]) as ds_hcho, nc.Dataset(no2_files[key]) as ds_no2, \
+                nc.Dataset(o3_files[key]) as ds_o3:
+            variables = (ds_hcho.variables[hcho_var], ds_no2.variables[no2_var], ds_o3.variables[o3_var])
+            if len({var.shape[1:] for var in variables}) != 1:
+                raise ValueError(f"HCHO, NO2 and O3 files of {key[0]}-{key[1]:02d} are not on the same grid")
+
+            # Pair the days by their time value (days since 1990-01-01)
+            times = [np.asarray(ds.variables['t'][:]) for ds in (ds_hcho, ds_no2, ds_o3)]
+            common = np.intersect1d(np.intersect1d(times[0], times[1]), times[2])
+            for day in common:
+                hcho, no2, o3 = (var[int(np.flatnonzero(t == day)[0])] for var, t in zip(variables, times))
+                date = (pd.Timestamp('1990-01-01') + pd.Timedelta(days=float(day))).strftime('%Y-%m-%d')
+                histogram.add(hcho, no2, o3, date)
+        print(f"{key[0]}-{key[1]:02d}: {len(common)} days")
+
+    centres, probability, totals, exceedances = histogram.probability(min_count)
+    pd.DataFrame({'FNR': centres, 'Probability': probability, 'Totals': totals, 'Exceedances': exceedances}) \
+        .to_csv(output_csv, sep=';', index=False)
+
+    # The peak and its CI are computed once here and saved with the histograms for the plot
+    x_peak, y_peak, low, high = peak_with_ci(histogram, min_count=min_count, n_boot=n_boot, block_size=block_size)
+    histogram.save(output_npz, x_peak=x_peak, y_peak=y_peak, peak_low=low, peak_high=high)
+    print(f"Peak exceedance probability {y_peak:.2f} at FNR {x_peak:.2f} ( {low:.1f} ~ {high:.1f} )")
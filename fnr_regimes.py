@@ -0,0 +1,137 @@
+import os
+import numpy as np
+import netCDF4 as nc
+from parallel_months import atomic_output, run_months
+from netcdf_writer import DailyNetCDFWriter
+
+# Photochemical regimes and the FNR (HCHO/NO2) thresholds between them
+REGIMES = ('VOC_LIMITED', 'TRANSITIONAL', 'NOX_LIMITED')
+FNR_THRESHOLDS = (1.5, 2.5)
+
+# Paths: daily HCHO and NO2 cubes (FR_<GAS>_YYYY_MM.nc), daily FNR output (read by trend_maps.py)
+# and monthly regime-frequency maps
+hcho_dir = 'D:/Data/SP/HCHO'
+no2_dir = 'D:/Data/SP/NO2'
+output_dir = 'D:/Data/SP/FNR'
+regime_dir = 'D:/Data/SP/FNR_REGIMES'
+
+# Quality masks: pixels need HCHO above min_hcho and NO2 above min_no2 (mol m-2) for a valid ratio
+min_hcho = 0.0
+min_no2 = 1e-6
+
+# Number of days read and processed at a time from each input file
+block_days = 8
+
+# Output chunk shape (t, y, x) and compression level; None writes one day per chunk
+nc_chunk_shape = None
+nc_complevel = 4
+
+# Parallel execution: number of worker processes (1 = serial), attempts per month,
+# per-month log folder, and an optional list of (year, month) to (re)run only those months
+workers = 1
+retries = 2
+log_dir = os.path.join(output_dir, "logs")
+only_months = None
+
+# Function to compute FNR = HCHO/NO2, NaN wherever either column is missing or fails the quality masks
+def fnr_ratio(hcho, no2, min_hcho=0.0, min_no2=1e-6):
+    hcho = np.ma.filled(np.ma.asarray(hcho, dtype='f8'), np.nan)
+    no2 = np.ma.filled(np.ma.asarray(no2, dtype='f8'), np.nan)
+    with np.errstate(invalid='ignore'):
+        valid = (hcho > min_hcho) & (no2 > min_no2)
+    return np.divide(hcho, no2, out=np.full(hcho.shape, np.nan), where=valid)
+
+# Function to classify FNR values into regimes: 0 (VOC-limited, up to the first threshold),
+# 1 (transitional) or 2 (NOx-limited, above the second threshold); -1 where FNR is NaN
+def classify_regimes(fnr, thresholds=FNR_THRESHOLDS):
+    regimes = np.digitize(fnr, thresholds, right=True).astype('i1')
+    regimes[np.isnan(fnr)] = -1
+    return regimes
+
+# Function to write the monthly regime counts and frequencies (fraction of the valid days)
+def write_regime_maps(path, lat, lon, counts, thresholds=FNR_THRESHOLDS):
+    n_valid = counts.sum(axis=0)
+    with atomic_output(path) as tmp_path, nc.Dataset(tmp_path, 'w', format='NETCDF4') as ds_out:
+        ds_out.createDimension('x', len(lon))
+        ds_out.createDimension('y', len(lat))
+
+        x_out = ds_out.createVariable('x', 'f4', ('x',))
+        y_out = ds_out.createVariable('y', 'f4', ('y',))
+        x_out.standard_name, x_out.units, x_out.long_name = "longitude", "degrees_east", "Longitude"
+        y_out.standard_name, y_out.units, y_out.long_name = "latitude", "degrees_north", "Latitude"
+        x_out[:] = lon
+        y_out[:] = lat
+
+        valid_out = ds_out.createVariable('n_valid', 'i2', ('y', 'x'))
+        valid_out.units, valid_out.long_name = "1", "Number of days with a valid FNR"
+        valid_out[:] = n_valid
+
+        for regime, count in zip(REGIMES, counts):
+            count_out = ds_out.createVariable(f"{regime}_count", 'i2', ('y', 'x'))
+            count_out.units, count_out.long_name = "1", f"Number of {regime.replace('_', '-').lower()} days"
+            count_out[:] = count
+
+            freq_out = ds_out.createVariable(f"{regime}_frequency", 'f4', ('y', 'x'), fill_value=np.nan)
+            freq_out.units = "1"
+            freq_out.long_name = f"Fraction of the valid days that are {regime.replace('_', '-').lower()}"
+            with np.errstate(divide='ignore', invalid='ignore'):
+                freq_out[:] = np.where(n_valid > 0, count / n_valid, np.nan)
+
+        ds_out.fnr_thresholds = np.array(thresholds, dtype='f4')
+
+def process_month(year, month):
+    # Computes the daily FNR and regimes of one month and its regime-frequency maps
+    hcho_path = os.path.join(hcho_dir, f"FR_HCHO_{year}_{month:02d}.nc")
+    no2_path = os.path.join(no2_dir, f"FR_NO2_{year}_{month:02d}.nc")
+
+    # Skip if one of the monthly files does not exist
+    if not os.path.exists(hcho_path) or not os.path.exists(no2_path):
+        return None
+
+    with nc.Dataset(hcho_path, 'r') as ds_hcho, nc.Dataset(no2_path, 'r') as ds_no2:
+        hcho_var, no2_var = ds_hcho.variables['HCHO'], ds_no2.variables['NO2']
+        if hcho_var.shape[1:] != no2_var.shape[1:]:
+            raise ValueError(f"HCHO and NO2 files of {year}-{month:02d} are not on the same grid")
+        lat, lon = ds_hcho.variables['y'][:], ds_hcho.variables['x'][:]
+
+        # Pair the days by their time value (days since 1990-01-01)
+        t_hcho, t_no2 = np.asarray(ds_hcho.variables['t'][:]), np.asarray(ds_no2.variables['t'][:])
+        days, i_hcho, i_no2 = np.intersect1d(t_hcho, t_no2, return_indices=True)
+        if len(days) == 0:
+            return None
+
+        variables = {
+            'FNR': {'long_name': "Formaldehyde to nitrogen dioxide ratio (HCHO/NO2)", 'units': "1"},
+            'REGIME': {'long_name': "Photochemical regime", 'units': "1", 'dtype': 'i1', '_FillValue': -1,
+                       'flag_values': np.arange(len(REGIMES), dtype='i1'), 'flag_meanings': " ".join(REGIMES).lower(),
+                       'fnr_thresholds': np.array(FNR_THRESHOLDS, dtype='f4')},
+        }
+
+        # Stream blocks of days: only one block of each product is in memory at a time, and the
+        # regime counts of the month are accumulated as the blocks are written
+        counts = np.zeros((len(REGIMES),) + hcho_var.shape[1:], dtype='i4')
+        nc_out = os.path.join(output_dir, f"FR_FNR_{year}_{month:02d}.nc")
+        with atomic_output(nc_out) as nc_tmp, DailyNetCDFWriter(
+            nc_tmp, lat, lon, variables, chunk_shape=nc_chunk_shape, complevel=nc_complevel
+        ) as writer:
+            for start in range(0, len(days), block_days):
+                block = slice(start, start + block_days)
+                fnr = fnr_ratio(hcho_var[i_hcho[block]], no2_var[i_no2[block]], min_hcho, min_no2)
+                regimes = classify_regimes(fnr)
+                for k in range(len(REGIMES)):
+                    counts[k] += (regimes == k).sum(axis=0)
+                writer.append(days[block], FNR=fnr, REGIME=regimes)
+
+    regime_out = os.path.join(regime_dir, f"FR_FNR_REGIMES_{year}_{month:02d}.nc")
+    write_regime_maps(regime_out, lat, lon, counts)
+    print(f"Saved monthly files: {nc_out}, {regime_out}")
+    return nc_out
+
+if __name__ == "__main__":
+    # Create output folders if they don't exist
+    os.makedirs(output_dir, exist_ok=True)
+    os.makedirs(regime_dir, exist_ok=True)
+
+    # Loop over all years and months
+    jobs = only_months or [(year, month) for year in range(2019, 2024) for month in range(1, 13)]
+    run_months(process_month, jobs, workers=workers, retries=retries, log_dir=log_dir)
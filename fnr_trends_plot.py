@@ -4,9 +4,11 @@ import matplotlib.pyplot as plt
 from scipy.stats import linregress
 from matplotlib import font_manager
 from scipy.interpolate import make_interp_spline
+from csv_cache import read_csv_cached
+from bootstrap import bootstrap_trends
 
 # Load CSV file
-data = pd.read_csv('D:/Data/FR/FNR/Trends_2019_2023.csv', sep=';', encoding='utf-8')
+data = read_csv_cached('D:/Data/FR/FNR/Trends_2019_2023.csv', sep=';', encoding='utf-8')
 
 # Font configuration
 font_path = 'D:/SF-Pro-Display-Regular.ttf'
@@ -38,8 +40,12 @@ numeric_cols = [
 for col in numeric_cols:
     data[col] = pd.to_numeric(data[col], errors='coerce')
 
-# Function to plot trend for each category
-def plot_trend(ax, x, y, yerr, label, color, ylabel):
+# Bootstrap settings for the trend confidence intervals (blocks of one year of seasons)
+n_boot = 10000
+block_size = 4
+
+# Function to plot trend for each category; ci is the (low, high) confidence interval of the slope
+def plot_trend(ax, x, y, yerr, label, color, ylabel, ci=None):
     ax.errorbar(x, y, yerr=yerr, fmt='o', color=color, ecolor=color, capsize=0, markersize=5)
     
     # Linear regression
@@ -56,8 +62,9 @@ def plot_trend(ax, x, y, yerr, label, color, ylabel):
             transform=ax.transAxes,
             fontproperties=font_prop_title)
     
+    ci_text = f" [{ci[0] * 1e-15:.3f}, {ci[1] * 1e-15:.3f}]" if ci is not None else ""
     ax.text(0.015 + 0.31, 0.75,
-            f"Average: {avg_value:.1f}  |  Linear trend: {slope_per_year:.3f} "
+            f"Average: {avg_value:.1f}  |  Linear trend: {slope_per_year:.3f}{ci_text} "
             "(10$^{15}$ molec cm$^{-2}$ year$^{-1}$)",
             transform=ax.transAxes,
             fontproperties=font_prop)
@@ -92,10 +99,16 @@ categories = [
     ('Forest_NO2_Mean', 'Forest_NO2_SD', 'Forest', 'goldenrod', ' ')
 ]
 
+# 95% bootstrap confidence intervals of the trends of all series, computed together
+_, trend_low, trend_high = bootstrap_trends(
+    data['x_index'], data[[category[0] for category in categories]], n_boot=n_boot, block_size=block_size
+)
+
 # Plot each category
 for i, (mean_col, sd_col, label, color, ylabel) in enumerate(categories):
     ax = axes[i]
-    plot_trend(ax, data['x_index'], data[mean_col], data[sd_col], label, color, ylabel)
+    plot_trend(ax, data['x_index'], data[mean_col], data[sd_col], label, color, ylabel,
+               ci=(trend_low[i], trend_high[i]))
     
     # Add vertical lines to separate specific years
     for year in [2020, 2021, 2022, 2023]:
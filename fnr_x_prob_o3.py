@@ -1,3 +1,4 @@
+import os
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
@@ -8,6 +9,15 @@ from scipy.stats import t
 # Load data from CSV
 df = pd.read_csv('D:/Data/SP/FNR/FNRxProbO3.csv', sep=';', encoding='utf-8')
 
+# Peak FNR and its bootstrap CI, computed by fnr_exceedance.py and saved with its histograms;
+# without them the peak is taken from the fit of the points alone
+peak_file = 'D:/Data/SP/FNR/FNRxProbO3_daily.npz'
+peak_ci = None
+if os.path.exists(peak_file):
+    with np.load(peak_file) as peak_data:
+        if 'x_peak' in peak_data.files:
+            peak_ci = tuple(float(peak_data[name]) for name in ('x_peak', 'peak_low', 'peak_high'))
+
 # Font configuration
 font_path = 'D:/SF-Pro-Display-Regular.ttf'
 font_path2 = 'D:/SF-Pro-Display-Black.ttf'
@@ -18,16 +28,20 @@ font_prop_title = font_manager.FontProperties(fname=font_path, size=25)
 x = df.iloc[:, 0].values  # FNR (HCHO/NO2)
 y = df.iloc[:, 1].values  # Ozone exceedance probability (%)
 
-# Fit a third-degree polynomial
-coef = np.polyfit(x, y, 3)  # Polynomial coefficients
+# Fit a third-degree polynomial, weighting the bins by their number of values when known
+weights = np.sqrt(df['Totals'].values) if 'Totals' in df.columns else None
+coef = np.polyfit(x, y, 3, w=weights)  # Polynomial coefficients
 poly = np.poly1d(coef)      # Create polynomial function
 
 # Generate smoothed curve values
 x_fit = np.linspace(min(x), max(x), 200)
 y_fit = poly(x_fit)
 
-# Find the peak of the curve
-x_peak = x_fit[np.argmax(y_fit)]
+# Find the peak of the curve (and its 95% bootstrap confidence interval when available)
+if peak_ci is not None:
+    x_peak, peak_low, peak_high = peak_ci
+else:
+    x_peak = x_fit[np.argmax(y_fit)]
 y_peak = max(y_fit)
 
 # Compute predicted (fitted) y values for the original x
@@ -67,14 +81,16 @@ ax.fill_between(x_fit, y_lower, y_upper, color='black', edgecolor='none', alpha=
 ax.axvline(x_peak, color='darkred', linestyle='-', linewidth=2)
 
 # Highlight uncertainty region
-ax.fill_betweenx([0, 0.4], x_peak - 0.4, x_peak + 0.4, color='red', edgecolor='none', alpha=0.2)
+if peak_ci is not None:
+    ax.fill_betweenx([0, 0.4], peak_low, peak_high, color='red', edgecolor='none', alpha=0.2)
 
 # Axis labels
 ax.set_xlabel('TROPOMI FNR (HCHO/NO$_2$)', fontsize=16, fontproperties=font_prop)
 ax.set_ylabel('Ozone exceedance probability', fontsize=16, fontproperties=font_prop)
 
 # Add text box in the upper-right corner
-text_str = f'1.98 ( 1.6 ~ 2.4 )\nR = {r_value:.2f}'
+peak_str = f'{x_peak:.2f} ( {peak_low:.1f} ~ {peak_high:.1f} )' if peak_ci is not None else f'{x_peak:.2f}'
+text_str = f'{peak_str}\nR = {r_value:.2f}'
 ax.text(
     0.95, 0.92, text_str,
     transform=ax.transAxes,
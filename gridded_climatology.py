@@ -0,0 +1,36 @@
+import os
+import netCDF4 as nc
+from climatology import ClimatologyEngine, file_dates
+
+# Directories
+input_dir = 'D:/Data/FR/HCHO'
+output_dir = 'D:/Data/FR/HCHO_CLIMATOLOGY'
+
+# Variable to average and output settings
+var_name = 'HCHO'
+units = "mol m-2"
+
+# Windows filled in the single pass: calendar months, seasons, seasons of each year and all data
+# ('year' adds one window per calendar year). Seasons: 'quarters' (JFM/AMJ/JAS/OND) or 'astronomical'
+windows = ('month', 'season', 'year_season', 'annual')
+seasons = 'quarters'
+
+files = sorted(f for f in os.listdir(input_dir) if f.endswith('.nc'))
+
+# Read every file once, adding its fields to all the windows they belong to
+engine = None
+for name in files:
+    with nc.Dataset(os.path.join(input_dir, name), 'r') as ds:
+        if engine is None:
+            x_data = ds.variables['x'][:]
+            y_data = ds.variables['y'][:]
+            engine = ClimatologyEngine((len(y_data), len(x_data)), windows, seasons)
+        elif ds.variables[var_name].shape[-2:] != engine.shape:
+            raise ValueError(f"{name} does not share the grid of the other files")
+
+        engine.add(file_dates(ds, name), ds.variables[var_name][:])
+    print(f"{name} added")
+
+# Write one NetCDF per window
+for path in engine.write(output_dir, y_data, x_data, var_name, f"{var_name}_CLIM", units):
+    print(f"Saved: {path}")
@@ -2,10 +2,38 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
 from matplotlib import font_manager
+from matplotlib.colors import LogNorm
+from fnr_regimes import FNR_THRESHOLDS
 
 # Load data from CSV
 df = pd.read_csv('D:/Data/FR/FNR/HCHOxNO2xO3.csv', sep=';', encoding='utf-8')
 
+# Rendering: 'scatter' draws every point; 'binned' aggregates the points on a (HCHO, NO2) grid of
+# bins (x bins, y bins) and draws it as one rasterised image, so the render time and file size do
+# not depend on the number of points. binned_stat: 'mean' (mean O3 per bin) or 'count'
+render_mode = 'binned'
+bins = (300, 200)
+binned_stat = 'mean'
+
+# Axis limits (also the extent of the binned grid)
+x_range = (0, 30e15)
+y_range = (0, 20e15)
+
+# Function to bin points on a regular (ny, nx) grid in one pass, returning the number of points
+# and the mean value per bin (NaN in empty bins); points outside the ranges are left out
+def bin_2d(x, y, values, x_range, y_range, bins):
+    x, y, values = (np.asarray(v, dtype='f8') for v in (x, y, values))
+    nx, ny = bins
+    ix = np.floor((x - x_range[0]) / (x_range[1] - x_range[0]) * nx)
+    iy = np.floor((y - y_range[0]) / (y_range[1] - y_range[0]) * ny)
+    keep = (ix >= 0) & (ix < nx) & (iy >= 0) & (iy < ny) & np.isfinite(values)
+    flat = iy[keep].astype('i8') * nx + ix[keep].astype('i8')
+    counts = np.bincount(flat, minlength=nx * ny).reshape(ny, nx)
+    sums = np.bincount(flat, weights=values[keep], minlength=nx * ny).reshape(ny, nx)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = np.where(counts > 0, sums / counts, np.nan)
+    return counts, means
+
 # Font configuration
 font_path = 'D:/SF-Pro-Display-Regular.ttf'
 font_path2 = 'D:/SF-Pro-Display-Black.ttf'
@@ -18,17 +46,32 @@ fig, ax = plt.subplots(figsize=(8, 5))
 # Add subplot title "(a)"
 ax.set_title('( a )', fontproperties=font_prop_title, loc='left', pad=20)
 
-# Scatter plot with color based on O3 values
-sc = ax.scatter(
-    df['HCHO'], df['NO2'], 
-    c=df['O3'], cmap='Spectral_r', edgecolors='none', s=50, vmin=50, vmax=130
-)
-# Alternative: hexbin plot
-# sc = ax.hexbin(df['HCHO'], df['NO2'], C=df['O3'], gridsize=100, cmap='Spectral_r', 
-#                edgecolors='none', reduce_C_function=np.mean, vmin=20, vmax=130)
+if render_mode == 'binned':
+    # Binned mean O3 (or number of points) drawn as a single raster layer of the vector figure
+    counts, means = bin_2d(df['HCHO'], df['NO2'], df['O3'], x_range, y_range, bins)
+    if binned_stat == 'count':
+        image, cmap, norm = np.where(counts > 0, counts, np.nan), 'viridis', LogNorm()
+        cbar_label = 'Number of values'
+    else:
+        image, cmap, norm = means, 'Spectral_r', None
+        cbar_label = r'O$_3$ ($\mathrm{\mu}$g m$^{-3}$)'
+    sc = ax.imshow(
+        image, origin='lower', extent=(*x_range, *y_range), aspect='auto', interpolation='nearest',
+        cmap=cmap, norm=norm, vmin=None if norm else 50, vmax=None if norm else 130, rasterized=True
+    )
+else:
+    # Scatter plot with color based on O3 values
+    sc = ax.scatter(
+        df['HCHO'], df['NO2'],
+        c=df['O3'], cmap='Spectral_r', edgecolors='none', s=50, vmin=50, vmax=130
+    )
+    cbar_label = r'O$_3$ ($\mathrm{\mu}$g m$^{-3}$)'
+    # Alternative: hexbin plot
+    # sc = ax.hexbin(df['HCHO'], df['NO2'], C=df['O3'], gridsize=100, cmap='Spectral_r', 
+    #                edgecolors='none', reduce_C_function=np.mean, vmin=20, vmax=130)
 
 # Add colorbar
-cbar = plt.colorbar(sc, ax=ax, label=r'O$_3$ ($\mathrm{\mu}$g m$^{-3}$)')
+cbar = plt.colorbar(sc, ax=ax, label=cbar_label)
 cbar.ax.yaxis.label.set_fontproperties(font_prop)
 cbar.outline.set_linewidth(1.5)
 cbar.ax.tick_params(labelsize=16, width=1.5)
@@ -42,8 +85,8 @@ ax.set_xlabel('HCHO ($10^{15}$ molecules cm$^{-2}$)', fontproperties=font_prop)
 ax.set_ylabel('NO$_2$ ($10^{15}$ molecules cm$^{-2}$)', fontproperties=font_prop)
 
 # Set axis limits
-ax.set_xlim(0, 30e15)
-ax.set_ylim(0, 20e15)
+ax.set_xlim(*x_range)
+ax.set_ylim(*y_range)
 ax.tick_params(axis='both', labelsize=16, width=1.5)
 
 # Adjust axis ticks to avoid scientific notation
@@ -62,8 +105,8 @@ ax.set_yticklabels([str(int(y / 1e15)) for y in ax.get_yticks()])
 
 # Add reference lines
 x = np.linspace(0, df['HCHO'].max(), 100)
-ax.plot(x, x/1.5, color='black', linestyle='-', linewidth=1)
-ax.plot(x, x/2.5, color='black', linestyle='-', linewidth=1)
+for threshold in FNR_THRESHOLDS:
+    ax.plot(x, x/threshold, color='black', linestyle='-', linewidth=1)
 
 # Grid styling
 ax.grid(True, linestyle='-', linewidth=0.7, color='gray', alpha=0.7)
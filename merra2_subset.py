@@ -0,0 +1,29 @@
+import numpy as np
+
+# Function to get the index slice of a monotonic 1-D coordinate that covers [lo, hi],
+# including the source nodes bracketing both ends plus `halo` extra cells on each side
+def coord_slice(coord, lo, hi, halo=1):
+    coord = np.ma.filled(np.asarray(coord, dtype='f8'), np.nan)
+    n = len(coord)
+
+    # Work on increasing coordinates and map the indices back afterwards
+    descending = n > 1 and coord[0] > coord[-1]
+    if descending:
+        coord = coord[::-1]
+
+    i_lo = np.searchsorted(coord, lo, side='right') - 1
+    i_hi = np.searchsorted(coord, hi, side='left')
+    start = max(i_lo - halo, 0)
+    stop = min(i_hi + halo + 1, n)
+
+    if descending:
+        start, stop = n - stop, n - start
+    return slice(int(start), int(stop))
+
+# Function to compute the lat/lon hyperslab of a source grid needed to cover a target grid
+def domain_slices(src_lat, src_lon, tgt_lat, tgt_lon, halo=1):
+    tgt_lat = np.ma.filled(np.asarray(tgt_lat, dtype='f8'), np.nan)
+    tgt_lon = np.ma.filled(np.asarray(tgt_lon, dtype='f8'), np.nan)
+    lat_slice = coord_slice(src_lat, np.nanmin(tgt_lat), np.nanmax(tgt_lat), halo)
+    lon_slice = coord_slice(src_lon, np.nanmin(tgt_lon), np.nanmax(tgt_lon), halo)
+    return lat_slice, lon_slice
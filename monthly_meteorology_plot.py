@@ -3,6 +3,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib import font_manager
 import os
+from csv_cache import read_csv_cached
 
 # Font configuration
 font_path = 'D:/SF-Pro-Display-Regular.ttf'
@@ -29,7 +30,11 @@ colors = {
 
 # CSV file path
 csv_file = 'D:/Data/SP/METEOROLOGY/SANTOS/Santos_Ponta_da_Praia_2019_2023.csv'
-df = pd.read_csv(csv_file, delimiter=';', encoding='ANSI')
+df = read_csv_cached(csv_file, delimiter=';', encoding='ANSI')
+
+# Parameter columns as numbers; cells that are not numeric become NaN
+for column in parameters:
+    df[column] = pd.to_numeric(df[column], errors='coerce')
 
 # Validate and create a datetime column
 df = df[(df['month'].between(1, 12)) & (df['day'].between(1, 31))]
@@ -2,36 +2,81 @@ import netCDF4 as nc
 import pandas as pd
 import numpy as np
 import os
+from parallel_months import atomic_output
 
-# Function to extract data from NetCDF and save as CSV
-def netcdf_to_csv(netcdf_file, csv_file):
-    
-    # Open the NetCDF file for reading
-    nc_data = nc.Dataset(netcdf_file, 'r')
-
-    # Extract variables
-    hcho_data = nc_data.variables['HCHO'][:]
-    x_data = nc_data.variables['x'][:]
-    y_data = nc_data.variables['y'][:]
-    t_data = nc_data.variables['t'][:]
-
-    # Close the NetCDF file
-    nc_data.close()
-
-    # Create a pandas DataFrame with extracted data
-    df = pd.DataFrame({
-        'HCHO': hcho_data.flatten(),
-        'x': x_data.tolist() * len(y_data) * len(t_data),
-        'y': np.tile(y_data.repeat(len(x_data)), len(t_data)),
-        't': t_data.repeat(len(x_data) * len(y_data)),
+# pyarrow is only needed for the Parquet and Arrow outputs
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+# Output format: 'parquet', 'arrow' (Arrow IPC file) or 'csv'
+output_format = 'parquet'
+
+# Drop fill/NaN pixels from the output
+drop_nan = False
+
+# Function to build the table of one time slice: values as float32, pixel coordinates and the date
+def slice_table(values, x_column, y_column, date, var_name, drop_nan=False):
+    values = np.ma.filled(values.astype('f4'), np.nan).ravel()
+    keep = ~np.isnan(values) if drop_nan else slice(None)
+    return pd.DataFrame({
+        var_name: values[keep],
+        'x': x_column[keep],
+        'y': y_column[keep],
+        't': np.full(len(values[keep]), date),
     })
-    
-    # Convert time variable to YYYY-MM-DD format
-    start_date = pd.to_datetime('1990-01-01')
-    df['t'] = start_date + pd.to_timedelta(df['t'], unit='D')
 
-    # Save the DataFrame to a CSV file
-    df.to_csv(csv_file, index=False)
+# Function to stream a NetCDF variable to Parquet, Arrow IPC or CSV, one time slice at a time
+def netcdf_to_table(netcdf_file, out_file, output_format='parquet', var_name='HCHO', drop_nan=False):
+    if output_format not in ('parquet', 'arrow', 'csv'):
+        raise ValueError(f"Unknown output format: {output_format}")
+
+    with nc.Dataset(netcdf_file, 'r') as nc_data, atomic_output(out_file) as tmp_file:
+        variable = nc_data.variables[var_name]
+        x_data = nc_data.variables['x'][:]
+        y_data = nc_data.variables['y'][:]
+        t_data = nc_data.variables['t'][:]
+
+        # Pixel coordinates of a (y, x) slice, in the same order as the flattened values
+        x_column = np.tile(np.asarray(x_data), len(y_data))
+        y_column = np.repeat(np.asarray(y_data), len(x_data))
+
+        # Convert time variable to dates
+        dates = (pd.to_datetime('1990-01-01') + pd.to_timedelta(np.asarray(t_data), unit='D')).to_numpy()
+
+        # A file without time slices still gets a table, with the columns (and schema) only
+        tables = (slice_table(variable[i], x_column, y_column, date, var_name, drop_nan)
+                  for i, date in enumerate(dates))
+        if len(dates) == 0:
+            print(f"{netcdf_file} has no time slices, writing an empty table")
+            tables = [slice_table(np.ma.zeros(0), x_column[:0], y_column[:0], np.datetime64('NaT', 'ns'), var_name)]
+
+        writer = None
+        try:
+            for i, table in enumerate(tables):
+                if output_format == 'csv':
+                    table.to_csv(tmp_file, index=False, mode='w' if i == 0 else 'a', header=i == 0)
+                    continue
+
+                # Each time slice becomes one record batch (a row group in Parquet)
+                table = pa.Table.from_pandas(table, preserve_index=False)
+                if writer is None:
+                    if output_format == 'parquet':
+                        writer = pq.ParquetWriter(tmp_file, table.schema, compression='zstd')
+                    else:
+                        writer = pa.ipc.new_file(tmp_file, table.schema)
+                writer.write_table(table)
+        finally:
+            if writer is not None:
+                writer.close()
+
+# Fall back to CSV when pyarrow is not installed
+if output_format != 'csv' and pa is None:
+    print(f"pyarrow is not installed, writing CSV instead of {output_format}")
+    output_format = 'csv'
+extension = {'parquet': '.parquet', 'arrow': '.arrow', 'csv': '.csv'}[output_format]
 
 # Check if output directory exists and create it if necessary
 csv_directory = "D:/Results/CSV_Files/FR/HCHO"
@@ -47,5 +92,5 @@ for root, dirs, files in os.walk(netcdf_directory):
         if name.endswith('.nc'):
             netcdf_file = os.path.join(root, name)
             netcdf_file_base = os.path.splitext(name)[0]
-            csv_file = os.path.join(csv_directory, f"{netcdf_file_base}.csv")
-            netcdf_to_csv(netcdf_file, csv_file)
\ No newline at end of file
+            out_file = os.path.join(csv_directory, f"{netcdf_file_base}{extension}")
+            netcdf_to_table(netcdf_file, out_file, output_format, drop_nan=drop_nan)
@@ -0,0 +1,62 @@
+import numpy as np
+import netCDF4 as nc
+
+# Default CF metadata of the coordinate variables
+COORD_ATTRS = {
+    't': {'standard_name': "time", 'long_name': "time", 'units': "days since 1990-01-01", 'axis': "T"},
+    'y': {'standard_name': "latitude", 'long_name': "latitude", 'units': "degrees_north"},
+    'x': {'standard_name': "longitude", 'long_name': "longitude", 'units': "degrees_east"},
+}
+
+# Incremental writer of (t, y, x) NetCDF files: the unlimited 't' dimension is created up front
+# and each day (or block of days) is appended as soon as it is computed
+class DailyNetCDFWriter:
+
+    def __init__(self, path, lat, lon, variables, chunk_shape=None, complevel=4, coord_attrs=None):
+        self.ds = nc.Dataset(path, 'w', format='NETCDF4')
+        self.ds.createDimension('t', None)
+        self.ds.createDimension('y', len(lat))
+        self.ds.createDimension('x', len(lon))
+
+        # Create coordinate variables
+        coord_attrs = coord_attrs or COORD_ATTRS
+        self.t_var = self.ds.createVariable('t', 'i4', ('t',))
+        y_var = self.ds.createVariable('y', 'f8', ('y',))
+        x_var = self.ds.createVariable('x', 'f8', ('x',))
+        for var, name in ((self.t_var, 't'), (y_var, 'y'), (x_var, 'x')):
+            var.setncatts(coord_attrs[name])
+        y_var[:] = lat
+        x_var[:] = lon
+
+        # Create data variables, chunked one day at a time unless told otherwise. Variables are
+        # float32 with NaN fill unless their attributes give a 'dtype' (and '_FillValue')
+        chunk_shape = chunk_shape or (1, len(lat), len(lon))
+        self.data_vars = {}
+        for name, attrs in variables.items():
+            attrs = dict(attrs)
+            dtype = attrs.pop('dtype', 'f4')
+            fill_value = attrs.pop('_FillValue', np.nan if np.dtype(dtype).kind == 'f' else None)
+            var = self.ds.createVariable(name, dtype, ('t', 'y', 'x'), fill_value=fill_value,
+                                         zlib=complevel > 0, complevel=max(complevel, 1),
+                                         chunksizes=chunk_shape)
+            var.setncatts(attrs)
+            self.data_vars[name] = var
+        self.n = 0
+
+    # Function to append one day (fields of shape (y, x)) or a block of days ((k, y, x))
+    def append(self, t, **fields):
+        t = np.atleast_1d(t)
+        k = len(t)
+        for name, data in fields.items():
+            self.data_vars[name][self.n:self.n + k, :, :] = np.reshape(data, (k,) + np.shape(data)[-2:])
+        self.t_var[self.n:self.n + k] = t
+        self.n += k
+
+    def close(self):
+        self.ds.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
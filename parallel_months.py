@@ -0,0 +1,65 @@
+import os
+import traceback
+import multiprocessing
+from contextlib import contextmanager, redirect_stdout, redirect_stderr, nullcontext
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+# Function to write an output file atomically: the caller writes to a temporary path,
+# which only replaces the final file once it has been written completely
+@contextmanager
+def atomic_output(path):
+    tmp_path = f"{path}.tmp"
+    try:
+        yield tmp_path
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+
+# Function to run one (year, month) job with retries, sending its output to a per-job log
+def run_job(func, year, month, retries=1, log_dir=None):
+    log = open(os.path.join(log_dir, f"{year}_{month:02d}.log"), 'a') if log_dir else None
+    error = None
+    try:
+        for attempt in range(1, retries + 1):
+            with redirect_stdout(log) if log else nullcontext(), redirect_stderr(log) if log else nullcontext():
+                try:
+                    print(f"[{year}-{month:02d}] attempt {attempt} of {retries}")
+                    return year, month, True, func(year, month)
+                except Exception:
+                    traceback.print_exc()
+                    error = traceback.format_exc().strip().splitlines()[-1]
+    finally:
+        if log:
+            log.close()
+    return year, month, False, error
+
+# Function to run every (year, month) job serially (workers <= 1) or in a process pool.
+# Both modes run the same job function, so their outputs are identical
+def run_months(func, jobs, workers=1, retries=1, log_dir=None):
+    if log_dir:
+        os.makedirs(log_dir, exist_ok=True)
+
+    results = []
+    if workers <= 1:
+        for year, month in jobs:
+            results.append(run_job(func, year, month, retries, log_dir))
+            year, month, ok, info = results[-1]
+            print(f" >> {year}-{month:02d}: {'ok' if ok else 'FAILED - ' + info}")
+    else:
+        # 'spawn' behaves the same on Windows and Linux and does not inherit open files/connections
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+            futures = [pool.submit(run_job, func, year, month, retries, log_dir) for year, month in jobs]
+            for future in as_completed(futures):
+                results.append(future.result())
+                year, month, ok, info = results[-1]
+                print(f" >> {year}-{month:02d}: {'ok' if ok else 'FAILED - ' + info}")
+
+    # Failed months can be rerun on their own without repeating the others
+    results.sort(key=lambda r: (r[0], r[1]))
+    failed = [(year, month) for year, month, ok, _ in results if not ok]
+    if failed:
+        print(f"Failed months: {failed}")
+    return results
@@ -1,16 +1,47 @@
 import os
+from contextlib import ExitStack
 import numpy as np
 import netCDF4 as nc
 import xarray as xr
-from scipy.interpolate import griddata
+from regridding import get_regridder, grid_hash
+from file_catalog import FileCatalog
+from merra2_subset import domain_slices
+from parallel_months import atomic_output, run_months
+from netcdf_writer import DailyNetCDFWriter
+from regrid_cache import RegriddedFieldCache
 
 # Paths
-HCHO_DIR = r"D:\Data\FR\HCHO"
 PBLH_DIR = r"D:\Data\FR\MERRA2\PBLH"
-OUT_DIR = r"D:\Data\FR\PBL\HCHO"
-os.makedirs(OUT_DIR, exist_ok=True)
+PBL_DIR = r"D:\Data\FR\PBL"
+WEIGHTS_DIR = r"D:\Data\FR\MERRA2\WEIGHTS"
+CATALOG_PATH = r"D:\Data\FR\MERRA2\catalog.sqlite"
+FIELD_CACHE_DIR = r"D:\Data\FR\MERRA2\REGRIDDED"
+FIELD_CACHE_MAX_GB = 20.0  # least recently used fields are evicted above this size
+
+# Column products processed together: each day's PBLH is loaded and regridded once
+# and used for every species. Outputs go to <PBL_DIR>/<species>/FR_<species>_PBL_YYYY_MM.nc
+SPECIES = {
+    'HCHO': {'dir': r"D:\Data\FR\HCHO", 'name': "Formaldehyde"},
+    'NO2': {'dir': r"D:\Data\FR\NO2", 'name': "Nitrogen dioxide"},
+}
+for species in SPECIES:
+    os.makedirs(os.path.join(PBL_DIR, species), exist_ok=True)
 
 YEARS = range(2019, 2024)  # inclusive
+REGRID_METHOD = 'linear'   # 'linear' or 'conservative' (area-weighted)
+
+# Parallel execution
+WORKERS = 1                # worker processes (1 = serial)
+RETRIES = 2                # attempts per month
+LOG_DIR = os.path.join(PBL_DIR, "logs")
+ONLY_MONTHS = None         # e.g. [(2020, 3)] to rerun only failed months
+
+# Output chunk shape (t, y, x) and compression level; None writes one day per chunk
+NC_CHUNK_SHAPE = None
+NC_COMPLEVEL = 4
+
+# Days of PBLH read and regridded together when they are missing from the regridded-field cache
+REGRID_BLOCK_DAYS = 8
 
 # Constants
 NA = 6.022e23        # molecules/mol
@@ -19,113 +50,176 @@ Ts = 12.38 + 273.15  # K
 ps = 99587.0         # Pa
 n_air_surf = ps * NA / (R * Ts)  # molecules/m³
 
-# Function to find file by date
-def find_file_by_date(folder, date_str):
-    suffix = f"{date_str}.SUB.nc"
-    for file in os.listdir(folder):
-        if file.endswith(suffix):
-            return os.path.join(folder, file)
-    return None
-
-# Function to load MERRA-2 PBLH data
-def load_merra2_pblh(date):
-    date_str = np.datetime_as_string(date, unit='D').replace('-', '')
-    path = find_file_by_date(PBLH_DIR, date_str)
-    if path is None:
-        return None
+# MERRA-2 file catalog (each worker process opens its own connection)
+catalog = FileCatalog(CATALOG_PATH)
+
+# Cache of PBLH fields already regridded to the TROPOMI grid
+field_cache = RegriddedFieldCache(FIELD_CACHE_DIR, max_gb=FIELD_CACHE_MAX_GB)
+
+# Function to get the (lat, lon) slices of a MERRA-2 granule that cover the target grid
+def merra2_domain(path, tgt_lat, tgt_lon):
+    with nc.Dataset(path) as ds:
+        return domain_slices(ds['lat'][:], ds['lon'][:], tgt_lat, tgt_lon)
+
+# Function to load the PBLH of a MERRA-2 granule, reading only the (lat, lon) slices of the domain
+def load_merra2_pblh(path, domain):
+    lat_sl, lon_sl = domain
     with nc.Dataset(path) as ds:
-        lat = ds['lat'][:]
-        lon = ds['lon'][:]
+        lat = ds['lat'][lat_sl]
+        lon = ds['lon'][lon_sl]
         pblh_var = 'PBLH' if 'PBLH' in ds.variables else list(ds.variables.keys())[-1]
-        pblh = ds[pblh_var][:]
+        pblh = ds[pblh_var][..., lat_sl, lon_sl]
         if pblh.ndim == 3:
             pblh = np.nanmean(pblh, axis=0)
     return lat, lon, pblh
 
-# Function to interpolate 2D data to target grid
-def interpolate_to_grid(src_lat, src_lon, src_data, tgt_lat, tgt_lon, method='linear'):
-    lon2d, lat2d = np.meshgrid(src_lon, src_lat)
-    points = np.column_stack((lon2d.ravel(), lat2d.ravel()))
-    values = src_data.ravel()
-    tgt_lon2d, tgt_lat2d = np.meshgrid(tgt_lon, tgt_lat)
-    tgt_points = np.column_stack((tgt_lon2d.ravel(), tgt_lat2d.ravel()))
-    interp_vals = griddata(points, values, tgt_points, method=method)
-    return interp_vals.reshape(len(tgt_lat), len(tgt_lon))
-
-# Loop over years and months
-for year in YEARS:
-    for month in range(1, 13):
-        
-        tropomi_file = f"FR_HCHO_{year}_{month:02d}.nc"
-        tropomi_path = os.path.join(HCHO_DIR, tropomi_file)
-        if not os.path.exists(tropomi_path):
-            continue
-
-        ds_tropomi = xr.open_dataset(tropomi_path)
-        lat_tropomi = ds_tropomi['y'].values
-        lon_tropomi = ds_tropomi['x'].values
-        dates = ds_tropomi['t'].values
-        hcho_vcd_mol_m2 = ds_tropomi['HCHO'].values  # mol/m²
-
-        hcho_pbl_month = []
-
-        for idx, date in enumerate(dates):
-            merra2_data = load_merra2_pblh(date)
-            if merra2_data is None:
-                continue
-            pblh_lat, pblh_lon, pblh_vals = merra2_data
-
-            # Interpolate PBLH to TROPOMI grid
-            pblh_interp = interpolate_to_grid(pblh_lat, pblh_lon, pblh_vals, lat_tropomi, lon_tropomi)
+# Function to interpolate 2D data (or a stack of 2D fields) to target grid
+def interpolate_to_grid(src_lat, src_lon, src_data, tgt_lat, tgt_lon):
+    regridder = get_regridder(src_lat, src_lon, tgt_lat, tgt_lon, cache_dir=WEIGHTS_DIR, method=REGRID_METHOD)
+    return regridder.regrid(src_data)
+
+# Function to get daily PBLH fields regridded to the target grid as float32 arrays memory-mapped
+# from the regridded-field cache, so a month of fields takes no memory; the missing days are
+# read, regridded and stored in blocks of REGRID_BLOCK_DAYS first. PBLH is regridded in double
+# precision and rounded to float32 for the cache, for cached and freshly regridded days alike
+def load_regridded_pblh(dates, tgt_lat, tgt_lon):
+    paths = {date: catalog.find('MERRA2', 'PBLH', date) for date in dates}
+    paths = {date: path for date, path in paths.items() if path is not None}
+    if len(paths) == 0:
+        return {}
+
+    # All granules of a month share the MERRA-2 grid, so the domain is read from the first one
+    domain = merra2_domain(next(iter(paths.values())), tgt_lat, tgt_lon)
+    grid_key = grid_hash(tgt_lat, tgt_lon)
+    fields = {}
+    missing = []
+    for date, path in paths.items():
+        key = field_cache.key(path, 'PBLH', grid_key, REGRID_METHOD, domain=domain)
+        field = field_cache.get(key)
+        if field is None:
+            missing.append((date, path, key))
+        else:
+            fields[date] = field
+
+    for start in range(0, len(missing), REGRID_BLOCK_DAYS):
+        block = missing[start:start + REGRID_BLOCK_DAYS]
+        loaded = [load_merra2_pblh(path, domain) for _, path, _ in block]
+        pblh_lat, pblh_lon = loaded[0][0], loaded[0][1]
+        pblh_stack = np.ma.stack([pblh for _, _, pblh in loaded])
+
+        # Interpolate the block's days to the target grid at once and store them
+        pblh_interp = interpolate_to_grid(pblh_lat, pblh_lon, pblh_stack, tgt_lat, tgt_lon).astype('f4')
+        for (date, _, key), field in zip(block, pblh_interp):
+            field_cache.put(key, field)
+            cached = field_cache.get(key)
+            fields[date] = field if cached is None else cached
+
+    return fields
+
+# Function to convert a TROPOMI date (datetime64, or already a day number) to days since 1990-01-01
+def days_since_1990(date):
+    if np.issubdtype(np.asarray(date).dtype, np.datetime64):
+        ref_date = np.datetime64('1990-01-01')
+        return int((date - ref_date).astype('timedelta64[D]').astype(int))
+    return int(date)
+
+# Function to compute and save the PBL mixing ratios of every species for one month
+def process_month(year, month):
+    ds_species = {}
+    for species, info in SPECIES.items():
+        tropomi_path = os.path.join(info['dir'], f"FR_{species}_{year}_{month:02d}.nc")
+        if os.path.exists(tropomi_path):
+            ds_species[species] = xr.open_dataset(tropomi_path)
+    if len(ds_species) == 0:
+        return None
+
+    # All species must share the TROPOMI grid, since PBLH is regridded only once
+    first = next(iter(ds_species.values()))
+    lat_tropomi = first['y'].values
+    lon_tropomi = first['x'].values
+    for species, ds_tropomi in ds_species.items():
+        if not (np.array_equal(ds_tropomi['y'].values, lat_tropomi)
+                and np.array_equal(ds_tropomi['x'].values, lon_tropomi)):
+            raise ValueError(f"{species} file for {year}-{month:02d} is on a different grid")
+
+    # Position of every date in each species file
+    day_index = {
+        species: {date: idx for idx, date in enumerate(ds_tropomi['t'].values)}
+        for species, ds_tropomi in ds_species.items()
+    }
+    dates = sorted(set().union(*day_index.values()))
+
+    # Get the regridded PBLH once per day for all species
+    pblh_fields = load_regridded_pblh(dates, lat_tropomi, lon_tropomi)
+    pblh_dates = sorted(pblh_fields)
+
+    if len(pblh_dates) == 0:
+        for ds_tropomi in ds_species.values():
+            ds_tropomi.close()
+        return None
+
+    # Save one NetCDF per species (written to temporary files first, then renamed),
+    # appending each block of days as soon as it is computed
+    nc_outs = {
+        species: os.path.join(PBL_DIR, species, f"FR_{species}_PBL_{year}_{month:02d}.nc")
+        for species in ds_species
+    }
+    block_days = NC_CHUNK_SHAPE[0] if NC_CHUNK_SHAPE else 1
+    with ExitStack() as stack:
+        writers = {}
+        for species, nc_out in nc_outs.items():
+            name = SPECIES[species]['name']
+            variables = {
+                f"{species}_PBL": {
+                    'long_name': f"PBL-mean {name} mixing ratio",
+                    'units': "ppbv",
+                    'description': f"Computed from TROPOMI {name} VCD and MERRA-2 PBLH without capping.",
+                }
+            }
+            nc_tmp = stack.enter_context(atomic_output(nc_out))
+            writers[species] = stack.enter_context(DailyNetCDFWriter(
+                nc_tmp, lat_tropomi, lon_tropomi, variables, chunk_shape=NC_CHUNK_SHAPE, complevel=NC_COMPLEVEL
+            ))
+
+        for start in range(0, len(pblh_dates), block_days):
+            block = slice(start, start + block_days)
+            block_dates = pblh_dates[block]
+
+            # PBLH on the TROPOMI grid (regridded once for all species), in double precision
+            pblh_interp = np.stack([pblh_fields[date] for date in block_dates]).astype('f8')
 
             # N_air,PBL in molecules/cm²
             N_air_PBL = pblh_interp * n_air_surf * 1e-4
-            
-            # Convert VCD to molecules/cm²
-            hcho_vcd_mol_cm2 = hcho_vcd_mol_m2[idx, :, :] * NA * 1e-4
-            
-            # Compute XPBL in ppbv
-            with np.errstate(divide='ignore', invalid='ignore'):
-                hcho_pbl = hcho_vcd_mol_cm2 / N_air_PBL * 1e9
-
-            hcho_pbl_month.append(hcho_pbl)
-
-        if len(hcho_pbl_month) == 0:
-            continue
-
-        hcho_pbl_month = np.array(hcho_pbl_month)
-
-        # Save NetCDF
-        nc_out = os.path.join(OUT_DIR, f"FR_HCHO_PBL_{year}_{month:02d}.nc")
-        with nc.Dataset(nc_out, 'w', format='NETCDF4') as ds_out:
-            ds_out.createDimension('t', None)
-            ds_out.createDimension('y', len(lat_tropomi))
-            ds_out.createDimension('x', len(lon_tropomi))
-
-            t_var = ds_out.createVariable('t', 'i4', ('t',))
-            y_var = ds_out.createVariable('y', 'f8', ('y',))
-            x_var = ds_out.createVariable('x', 'f8', ('x',))
-            hcho_var = ds_out.createVariable('HCHO_PBL', 'f4', ('t', 'y', 'x'), fill_value=np.nan, zlib=True)
-
-            t_var.units = "days since 1990-01-01"
-            t_var.long_name = "time"
-            t_var.axis = "T"
-            y_var.units = "degrees_north"
-            y_var.long_name = "latitude"
-            x_var.units = "degrees_east"
-            x_var.long_name = "longitude"
-
-            hcho_var.long_name = "PBL-mean Formaldehyde mixing ratio"
-            hcho_var.units = "ppbv"
-            hcho_var.description = (
-                "Computed from TROPOMI Formaldehyde VCD and MERRA-2 PBLH without capping."
-            )
-
-            t_var[:] = np.arange(len(hcho_pbl_month))
-            y_var[:] = lat_tropomi
-            x_var[:] = lon_tropomi
-            hcho_var[:, :, :] = hcho_pbl_month
 
+            for species, ds_tropomi in ds_species.items():
+                rows = [i for i, date in enumerate(block_dates) if date in day_index[species]]
+                if len(rows) == 0:
+                    continue
+
+                # Convert VCD to molecules/cm²
+                vcd_mol_m2 = ds_tropomi[species][[day_index[species][block_dates[i]] for i in rows]].values  # mol/m²
+                vcd_mol_cm2 = vcd_mol_m2 * NA * 1e-4
+
+                # Compute XPBL in ppbv
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    x_pbl = vcd_mol_cm2 / N_air_PBL[rows] * 1e9
+
+                # Convert time to "days since 1990-01-01" (the units of the output 't' axis)
+                time_days = [days_since_1990(block_dates[i]) for i in rows]
+                writers[species].append(time_days, **{f"{species}_PBL": x_pbl})
+
+    for ds_tropomi in ds_species.values():
+        ds_tropomi.close()
+    for nc_out in nc_outs.values():
         print(f" >> Saved monthly file: {nc_out}")
+    return list(nc_outs.values())
+
+if __name__ == "__main__":
+    # Index the MERRA-2 PBLH folder once; only new or changed granules are scanned again
+    catalog.refresh(PBLH_DIR, 'MERRA2', 'PBLH')
+
+    # Loop over years and months
+    jobs = ONLY_MONTHS or [(year, month) for year in YEARS for month in range(1, 13)]
+    run_months(process_month, jobs, workers=WORKERS, retries=RETRIES, log_dir=LOG_DIR)
 
-print("Done.")
\ No newline at end of file
+    print("Done.")
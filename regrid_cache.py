@@ -0,0 +1,84 @@
+import os
+import hashlib
+import numpy as np
+from file_catalog import file_fingerprint
+
+# Persistent cache of daily fields already regridded to a target grid. Each field is a float32
+# .npy file (opened memory-mapped), keyed by the source files, variable, source hyperslab, target
+# grid and regridding method, and the least recently used fields are evicted above max_gb
+class RegriddedFieldCache:
+
+    def __init__(self, cache_dir, max_gb=20.0):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_gb * 1024 ** 3)
+        self.size = None
+        os.makedirs(cache_dir, exist_ok=True)
+
+    # Function to build the cache key of a field from its source file(s) and regridding setup;
+    # domain holds the (lat, lon) slices of the source hyperslab that was read, if only part was
+    def key(self, source_paths, variable, grid_key, method, domain=None):
+        if isinstance(source_paths, str):
+            source_paths = [source_paths]
+        h = hashlib.sha1()
+        for path in source_paths:
+            h.update(file_fingerprint(path).encode())
+        h.update(f"|{variable}|{grid_key}|{method}".encode())
+        if domain is not None:
+            h.update("|".join(f"{sl.start}:{sl.stop}" for sl in domain).encode())
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.npy")
+
+    # Function to get a cached field (memory-mapped, read-only) or None
+    def get(self, key):
+        path = self.path(key)
+        try:
+            field = np.load(path, mmap_mode='r')
+            os.utime(path)  # mark as recently used
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+        return field
+
+    # Function to store a field; written to a temporary file first so readers never see partial data
+    def put(self, key, field):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.asarray(field, dtype='f4'))
+        os.replace(tmp_path, path)
+
+        if self.size is None:
+            self.size = self.total_size()
+        else:
+            self.size += os.path.getsize(path)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def entries(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith('.npy'):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    yield stat.st_mtime, stat.st_size, path
+
+    def total_size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    # Function to remove least recently used fields until the cache is below 90% of its limit
+    def evict(self):
+        entries = sorted(self.entries())
+        self.size = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self.size <= 0.9 * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue  # already removed or still open in another process
+            self.size -= size
@@ -0,0 +1,231 @@
+import os
+import hashlib
+import numpy as np
+from scipy import sparse
+from scipy.spatial import Delaunay
+
+# Regridders already built in this process, keyed by method and grid hash
+_regridders = {}
+
+# Function to hash one or more coordinate arrays into a short key for cached weights
+def grid_hash(*arrays):
+    h = hashlib.sha1()
+    for arr in arrays:
+        arr = np.ascontiguousarray(np.ma.filled(np.asarray(arr, dtype='f8'), np.nan))
+        h.update(str(arr.shape).encode())
+        h.update(arr.tobytes())
+    return h.hexdigest()[:16]
+
+# Function to turn 1-D or 2-D lat/lon coordinates into flattened (lon, lat) points
+def grid_points(lat, lon):
+    lat = np.ma.filled(np.asarray(lat, dtype='f8'), np.nan)
+    lon = np.ma.filled(np.asarray(lon, dtype='f8'), np.nan)
+    if lat.ndim == 1 and lon.ndim == 1:
+        lon, lat = np.meshgrid(lon, lat)
+    return np.column_stack((lon.ravel(), lat.ravel())), lat.shape
+
+# Function to build linear (barycentric) interpolation weights as a sparse matrix,
+# giving the same result as griddata(method='linear') for every target point
+def linear_weights(src_lat, src_lon, tgt_lat, tgt_lon):
+    src_points, _ = grid_points(src_lat, src_lon)
+    tgt_points, _ = grid_points(tgt_lat, tgt_lon)
+
+    # Triangulate the source grid once and locate every target point in it
+    tri = Delaunay(src_points)
+    simplex = tri.find_simplex(tgt_points)
+    inside = np.flatnonzero(simplex >= 0)
+
+    # Barycentric coordinates of the target points inside the convex hull
+    transform = tri.transform[simplex[inside]]
+    b = np.einsum('ijk,ik->ij', transform[:, :2], tgt_points[inside] - transform[:, 2])
+    bary = np.column_stack((b, 1.0 - b.sum(axis=1)))
+
+    rows = np.repeat(inside, 3)
+    cols = tri.simplices[simplex[inside]].ravel()
+    weights = sparse.csr_matrix((bary.ravel(), (rows, cols)), shape=(len(tgt_points), len(src_points)))
+    weights.eliminate_zeros()
+    return weights
+
+# Function to check whether a coordinate array is 1-D and strictly monotonic
+def is_monotonic(coord):
+    coord = np.ma.filled(np.asarray(coord, dtype='f8'), np.nan)
+    if coord.ndim != 1 or len(coord) < 2:
+        return False
+    step = np.diff(coord)
+    return bool(np.all(step > 0) or np.all(step < 0))
+
+# Function to build the index/weight vectors of 1-D linear interpolation along one axis
+def axis_weights(src, tgt):
+    src = np.ma.filled(np.asarray(src, dtype='f8'), np.nan)
+    tgt = np.ma.filled(np.asarray(tgt, dtype='f8'), np.nan)
+    n = len(src)
+
+    # Work on increasing coordinates and map the indices back afterwards
+    descending = src[0] > src[-1]
+    if descending:
+        src = src[::-1]
+
+    i0 = np.clip(np.searchsorted(src, tgt, side='right') - 1, 0, n - 2)
+    w = (tgt - src[i0]) / (src[i0 + 1] - src[i0])
+    outside = (tgt < src[0]) | (tgt > src[-1]) | np.isnan(tgt)
+
+    # Points falling exactly on a source node (including the last one) only use that node
+    i1 = np.where(w == 0.0, i0, i0 + 1)
+    i0 = np.where(w == 1.0, i1, i0)
+    if descending:
+        i0, i1, w = n - 1 - i1, n - 1 - i0, 1.0 - w
+    return i0, i1, w, outside
+
+# Regridder for rectilinear grids: bilinear interpolation done as a row pass then a column pass
+class SeparableRegridder:
+
+    def __init__(self, src_lat, src_lon, tgt_lat, tgt_lon):
+        self.src_shape = (len(src_lat), len(src_lon))
+        self.tgt_shape = (len(tgt_lat), len(tgt_lon))
+        self.lat_weights = axis_weights(src_lat, tgt_lat)
+        self.lon_weights = axis_weights(src_lon, tgt_lon)
+
+    # Function to regrid a single (lat, lon) field or a whole (t, lat, lon) stack
+    def regrid(self, data):
+        data = np.ma.filled(np.ma.asarray(data, dtype='f8'), np.nan)
+
+        # Row pass: interpolate along latitude
+        i0, i1, w, outside = self.lat_weights
+        rows = data[..., i0, :] * (1.0 - w)[:, np.newaxis] + data[..., i1, :] * w[:, np.newaxis]
+        rows[..., outside, :] = np.nan
+
+        # Column pass: interpolate along longitude
+        i0, i1, w, outside = self.lon_weights
+        out = rows[..., i0] * (1.0 - w) + rows[..., i1] * w
+        out[..., outside] = np.nan
+        return out
+
+# Function to load sparse weights saved by a previous run, otherwise build and save them
+def load_or_build_weights(cache_dir, file_name, build):
+    if cache_dir is None:
+        return build()
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_path = os.path.join(cache_dir, file_name)
+    if os.path.exists(cache_path):
+        return sparse.load_npz(cache_path).tocsr()
+    weights = build()
+    # Write under a per-process name first, so parallel workers never read a partial file
+    tmp_path = f"{cache_path[:-len('.npz')]}.{os.getpid()}.tmp.npz"
+    sparse.save_npz(tmp_path, weights)
+    os.replace(tmp_path, cache_path)
+    return weights
+
+# Regridder for scattered or curvilinear grids, keeping the interpolation weights
+# for one (source grid, target grid) pair as a sparse matrix
+class Regridder:
+
+    def __init__(self, src_lat, src_lon, tgt_lat, tgt_lon, cache_dir=None):
+        self.src_shape = grid_points(src_lat, src_lon)[1]
+        self.tgt_shape = grid_points(tgt_lat, tgt_lon)[1]
+        self.key = grid_hash(src_lat, src_lon, tgt_lat, tgt_lon)
+        self.weights = load_or_build_weights(
+            cache_dir, f"linear_{self.key}.npz",
+            lambda: linear_weights(src_lat, src_lon, tgt_lat, tgt_lon)
+        )
+
+        # Target points outside the source grid have no weights and are set to NaN
+        self.outside = np.diff(self.weights.indptr) == 0
+
+    # Function to regrid a single (lat, lon) field or a whole (t, lat, lon) stack
+    def regrid(self, data):
+        data = np.ma.filled(np.ma.asarray(data, dtype='f8'), np.nan)
+        lead_shape = data.shape[:-len(self.src_shape)]
+        stack = data.reshape(-1, self.weights.shape[1])
+
+        # One sparse matmul for every field in the stack
+        out = (self.weights @ stack.T).T
+        out[:, self.outside] = np.nan
+        return out.reshape(lead_shape + self.tgt_shape)
+
+# Function to compute cell edges from 1-D cell-centre coordinates
+def cell_bounds(coord):
+    coord = np.ma.filled(np.asarray(coord, dtype='f8'), np.nan)
+    mid = 0.5 * (coord[1:] + coord[:-1])
+    first = coord[0] - (mid[0] - coord[0])
+    last = coord[-1] + (coord[-1] - mid[-1])
+    return np.concatenate(([first], mid, [last]))
+
+# Function to compute the overlap between source and target cells along one axis.
+# Latitude overlaps are measured in sin(lat) so that lat x lon products are areas on the sphere
+def overlap_matrix(src_coord, tgt_coord, is_lat=False):
+    src_edges = cell_bounds(src_coord)
+    tgt_edges = cell_bounds(tgt_coord)
+    if is_lat:
+        src_edges = np.sin(np.deg2rad(np.clip(src_edges, -90.0, 90.0)))
+        tgt_edges = np.sin(np.deg2rad(np.clip(tgt_edges, -90.0, 90.0)))
+
+    src_lo = np.minimum(src_edges[:-1], src_edges[1:])
+    src_hi = np.maximum(src_edges[:-1], src_edges[1:])
+    tgt_lo = np.minimum(tgt_edges[:-1], tgt_edges[1:])
+    tgt_hi = np.maximum(tgt_edges[:-1], tgt_edges[1:])
+
+    overlap = (np.minimum(tgt_hi[:, np.newaxis], src_hi[np.newaxis, :])
+               - np.maximum(tgt_lo[:, np.newaxis], src_lo[np.newaxis, :]))
+    return sparse.csr_matrix(np.clip(overlap, 0.0, None))
+
+# Function to build first-order conservative weights (overlap areas, target x source)
+def conservative_weights(src_lat, src_lon, tgt_lat, tgt_lon):
+    for coord in (src_lat, src_lon, tgt_lat, tgt_lon):
+        if not is_monotonic(coord):
+            raise ValueError("conservative regridding needs monotonic 1-D lat/lon coordinates")
+
+    # Rectilinear cells: the 2-D overlap is the product of the lat and lon overlaps
+    lat_overlap = overlap_matrix(src_lat, tgt_lat, is_lat=True)
+    lon_overlap = overlap_matrix(src_lon, tgt_lon)
+    weights = sparse.kron(lat_overlap, lon_overlap, format='csr')
+    weights.eliminate_zeros()
+    return weights
+
+# Conservative regridder: each target cell is the area-weighted mean of the source cells
+# it overlaps, renormalised over the valid (non-NaN) source cells
+class ConservativeRegridder:
+
+    def __init__(self, src_lat, src_lon, tgt_lat, tgt_lon, cache_dir=None, min_coverage=0.5):
+        self.src_shape = (len(src_lat), len(src_lon))
+        self.tgt_shape = (len(tgt_lat), len(tgt_lon))
+        self.key = grid_hash(src_lat, src_lon, tgt_lat, tgt_lon)
+        self.min_coverage = min_coverage
+        self.weights = load_or_build_weights(
+            cache_dir, f"conservative_{self.key}.npz",
+            lambda: conservative_weights(src_lat, src_lon, tgt_lat, tgt_lon)
+        )
+        self.covered_area = np.asarray(self.weights.sum(axis=1)).ravel()
+
+    # Function to regrid a single (lat, lon) field or a whole (t, lat, lon) stack
+    def regrid(self, data):
+        data = np.ma.filled(np.ma.asarray(data, dtype='f8'), np.nan)
+        lead_shape = data.shape[:-2]
+        stack = data.reshape(-1, self.weights.shape[1]).T
+        valid = np.isfinite(stack)
+
+        # Weighted sums over valid source cells and the area they cover, for all fields at once
+        total = self.weights @ np.where(valid, stack, 0.0)
+        valid_area = self.weights @ valid.astype('f8')
+
+        # Renormalise by the valid area; cells with too little valid coverage become NaN
+        with np.errstate(divide='ignore', invalid='ignore'):
+            out = total / valid_area
+        out[valid_area <= self.min_coverage * self.covered_area[:, np.newaxis]] = np.nan
+        return out.T.reshape(lead_shape + self.tgt_shape)
+
+# Function to get a regridder for a grid pair, building it at most once per process.
+# For method='linear', rectilinear sources (monotonic 1-D coordinates) with 1-D targets use
+# the separable bilinear path; the scattered Delaunay path is only used for truly irregular
+# coordinates. method='conservative' uses area-weighted overlap weights
+def get_regridder(src_lat, src_lon, tgt_lat, tgt_lon, cache_dir=None, method='linear'):
+    key = (method, grid_hash(src_lat, src_lon, tgt_lat, tgt_lon))
+    if key not in _regridders:
+        if method == 'conservative':
+            _regridders[key] = ConservativeRegridder(src_lat, src_lon, tgt_lat, tgt_lon, cache_dir=cache_dir)
+        elif method != 'linear':
+            raise ValueError(f"Unknown regridding method: {method}")
+        elif is_monotonic(src_lat) and is_monotonic(src_lon) and np.ndim(tgt_lat) == 1 and np.ndim(tgt_lon) == 1:
+            _regridders[key] = SeparableRegridder(src_lat, src_lon, tgt_lat, tgt_lon)
+        else:
+            _regridders[key] = Regridder(src_lat, src_lon, tgt_lat, tgt_lon, cache_dir=cache_dir)
+    return _regridders[key]
@@ -5,6 +5,8 @@ from scipy.stats import linregress
 from scipy.interpolate import make_interp_spline
 from matplotlib import font_manager
 import os
+from csv_cache import read_csv_cached
+from bootstrap import bootstrap_trends, bootstrap_means
 
 # Fonts
 font_path = 'D:/SF-Pro-Display-Regular.ttf'
@@ -17,7 +19,7 @@ conversion_factor = 6.02214e19
 
 # CSV file
 csv_path = 'D:/Results/Dataframes/FR/FR_HCHO.csv'
-df = pd.read_csv(csv_path, parse_dates=['day'])
+df = read_csv_cached(csv_path, parse_dates=['day'])
 output_dir = os.path.dirname(csv_path)
 
 # Convert units
@@ -42,6 +44,22 @@ df['Season'] = pd.Categorical(df['Season'], categories=season_order, ordered=Tru
 seasonal = df.groupby('Season')[areas].agg(['mean', 'std']).reset_index()
 seasonal.columns = ['Season'] + [f'{area}_{stat}' for area in areas for stat in ['mean', 'std']]
 
+# Bootstrap settings: resamples and block length in days (keeps short-term autocorrelation)
+n_boot = 10000
+block_size = 30
+
+# 95% bootstrap confidence intervals of the seasonal means and of the trends of all areas
+for season in season_order:
+    _, low, high = bootstrap_means(df.loc[df['Season'] == season, areas], n_boot=n_boot, block_size=block_size)
+    for area, lo, hi in zip(areas, low, high):
+        seasonal.loc[seasonal['Season'] == season, f'{area}_ci_low'] = lo
+        seasonal.loc[seasonal['Season'] == season, f'{area}_ci_high'] = hi
+
+trend_slopes, trend_low, trend_high = bootstrap_trends(
+    df['day'].map(pd.Timestamp.toordinal), df[areas], n_boot=n_boot, block_size=block_size
+)
+trend_ci = {area: (lo, hi) for area, lo, hi in zip(areas, trend_low, trend_high)}
+
 # Colors
 color = '#1E40AF'
 error_color = '#444444'
@@ -60,8 +78,11 @@ def plot_area(ax, area, show_y_ticks=True):
     y = seasonal[f'{area}_mean'].values
     yerr = seasonal[f'{area}_std'].values
 
+    ci_low = seasonal[f'{area}_ci_low'].values
+    ci_high = seasonal[f'{area}_ci_high'].values
+
     mask = ~np.isnan(y) & ~np.isnan(yerr)
-    x, y, yerr = x[mask], y[mask], yerr[mask]
+    x, y, yerr, ci_low, ci_high = x[mask], y[mask], yerr[mask], ci_low[mask], ci_high[mask]
 
     # Smoothed line
     if len(x) >= 4:
@@ -73,6 +94,10 @@ def plot_area(ax, area, show_y_ticks=True):
     ax.errorbar(x, y, yerr=yerr, fmt='o', color=color, ecolor=error_color,
                 capsize=0, markersize=8, zorder=3)
 
+    # Thicker bars for the 95% confidence interval of the mean
+    ax.errorbar(x, y, yerr=[y - ci_low, ci_high - y], fmt='none', ecolor=color,
+                elinewidth=4, capsize=0, zorder=4)
+
     # Shaded area for standard deviation
     if len(x) >= 4:
         upper_spline = make_interp_spline(x, y + yerr)(x_smooth)
@@ -94,7 +119,8 @@ def plot_area(ax, area, show_y_ticks=True):
     ax.text(0.04, 0.88, label_clean, transform=ax.transAxes, fontproperties=font_prop_black)
     ax.text(0.04, 0.78, rf'Average: {avg:.1f} ± {sd:.1f}',
             transform=ax.transAxes, fontsize=18, fontproperties=font_prop)
-    ax.text(0.04, 0.68, rf'Annual trend: {slope_per_year:.3f}',
+    ci_low_year, ci_high_year = (v * 365.25 / 1e15 for v in trend_ci[area])
+    ax.text(0.04, 0.68, rf'Annual trend: {slope_per_year:.3f} [{ci_low_year:.3f}, {ci_high_year:.3f}]',
             transform=ax.transAxes, fontsize=18, fontproperties=font_prop)
 
     # Y-axis
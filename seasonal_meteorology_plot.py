@@ -3,6 +3,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib import font_manager
 import os
+from csv_cache import read_csv_cached
 
 # Font configuration
 font_path = 'D:/SF-Pro-Display-Regular.ttf'
@@ -21,7 +22,11 @@ season_order = ['Winter', 'Spring', 'Summer', 'Autumn']
 
 # Path to the CSV file
 csv_file = 'D:/Data/FR/METEOROLOGY/CLERMONT_FERRAND/Clermont_Ferrand_2019_2023.csv'
-df = pd.read_csv(csv_file, delimiter=';', encoding='ANSI')
+df = read_csv_cached(csv_file, delimiter=';', encoding='ANSI')
+
+# Parameter columns as numbers; cells that are not numeric become NaN
+for column in ['temp', 'umid', 'pres', 'prec']:
+    df[column] = pd.to_numeric(df[column], errors='coerce')
 
 # Date validation
 df = df[(df['mês'].between(1, 12)) & (df['dia'].between(1, 31))]
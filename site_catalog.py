@@ -0,0 +1,131 @@
+import json
+import hashlib
+import numpy as np
+from scipy import sparse
+from regridding import grid_hash, load_or_build_weights
+
+EARTH_RADIUS_KM = 6371.0
+
+# Membership matrices already built in this process, keyed by (grid hash, sites hash)
+_memberships = {}
+
+# Sites are dicts with a 'name' and one of the following geometries:
+#   box:     'lat_range': (lat_min, lat_max), 'lon_range': (lon_min, lon_max)
+#   point:   'point': (lat, lon), 'radius_km': r (0 = the pixel containing the point)
+#   polygon: 'polygon': [polygon, ...], each polygon a list of rings of [lon, lat] vertices
+#            (outer ring first, then holes), as in GeoJSON Polygon/MultiPolygon coordinates
+
+# Function to read sites from a GeoJSON file: Polygon/MultiPolygon features become polygon
+# sites and Point features become point sites (radius from the 'radius_km' property)
+def load_geojson_sites(path, name_property='name', default_radius_km=0.0):
+    with open(path, encoding='utf-8') as f:
+        collection = json.load(f)
+
+    sites = []
+    for i, feature in enumerate(collection['features']):
+        properties = feature.get('properties') or {}
+        name = str(properties.get(name_property, f"site_{i}"))
+        geometry = feature['geometry']
+        if geometry['type'] == 'Point':
+            lon, lat = geometry['coordinates'][:2]
+            radius = float(properties.get('radius_km', default_radius_km))
+            sites.append({'name': name, 'point': (lat, lon), 'radius_km': radius})
+        elif geometry['type'] == 'Polygon':
+            sites.append({'name': name, 'polygon': [geometry['coordinates']]})
+        elif geometry['type'] == 'MultiPolygon':
+            sites.append({'name': name, 'polygon': geometry['coordinates']})
+        else:
+            raise ValueError(f"Unsupported geometry type for site '{name}': {geometry['type']}")
+    return sites
+
+# Function to hash site definitions, so cached memberships follow any change to the sites
+def sites_hash(sites):
+    return hashlib.sha1(json.dumps(sites, sort_keys=True, default=float).encode()).hexdigest()[:16]
+
+# Function to test which points fall inside a ring (even-odd rule)
+def points_in_ring(lon, lat, ring):
+    ring = np.asarray(ring, dtype='f8')[:, :2]
+    xa, ya = ring[:, 0], ring[:, 1]
+    xb, yb = np.roll(xa, -1), np.roll(ya, -1)
+    inside = np.zeros(lon.shape, dtype=bool)
+    for x1, y1, x2, y2 in zip(xa, ya, xb, yb):
+        if y1 == y2:
+            continue
+        crosses = (y1 > lat) != (y2 > lat)
+        x_cross = x1 + (lat - y1) * (x2 - x1) / (y2 - y1)
+        inside ^= crosses & (lon < x_cross)
+    return inside
+
+# Function to get the pixel centres (flattened lat, lon) that belong to one site
+def site_mask(site, lat, lon):
+    if 'lat_range' in site:
+        return ((lat >= site['lat_range'][0]) & (lat <= site['lat_range'][1]) &
+                (lon >= site['lon_range'][0]) & (lon <= site['lon_range'][1]))
+
+    if 'point' in site:
+        lat0, lon0 = np.radians(site['point'])
+        phi, lam = np.radians(lat), np.radians(lon)
+        a = np.sin((phi - lat0) / 2) ** 2 + np.cos(lat0) * np.cos(phi) * np.sin((lam - lon0) / 2) ** 2
+        distance = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+        mask = distance <= site.get('radius_km', 0.0)
+        # A point smaller than a pixel still takes the pixel it falls in, if it lies on the grid
+        inside_grid = lat.min() <= site['point'][0] <= lat.max() and lon.min() <= site['point'][1] <= lon.max()
+        if not mask.any() and inside_grid:
+            mask[np.argmin(distance)] = True
+        return mask
+
+    if 'polygon' in site:
+        mask = np.zeros(lat.shape, dtype=bool)
+        for polygon in site['polygon']:
+            outer = np.asarray(polygon[0], dtype='f8')
+            # Only pixels inside the bounding box of the polygon are tested
+            candidates = np.flatnonzero(
+                (lon >= outer[:, 0].min()) & (lon <= outer[:, 0].max()) &
+                (lat >= outer[:, 1].min()) & (lat <= outer[:, 1].max())
+            )
+            inside = points_in_ring(lon[candidates], lat[candidates], outer)
+            for hole in polygon[1:]:
+                inside &= ~points_in_ring(lon[candidates], lat[candidates], hole)
+            mask[candidates[inside]] = True
+        return mask
+
+    raise ValueError(f"Site '{site.get('name')}' has no box, point or polygon geometry")
+
+# Function to build the sparse (n_sites, ny * nx) pixel-membership matrix of a grid
+def membership_weights(sites, lat, lon):
+    lat = np.ma.filled(np.asarray(lat, dtype='f8'), np.nan)
+    lon = np.ma.filled(np.asarray(lon, dtype='f8'), np.nan)
+    if lat.ndim == 1 and lon.ndim == 1:
+        lon, lat = np.meshgrid(lon, lat)
+    lat, lon = lat.ravel(), lon.ravel()
+
+    rows, cols = [], []
+    for i, site in enumerate(sites):
+        pixels = np.flatnonzero(site_mask(site, lat, lon))
+        rows.append(np.full(len(pixels), i))
+        cols.append(pixels)
+    rows, cols = np.concatenate(rows), np.concatenate(cols)
+    return sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(sites), lat.size))
+
+# Function to get the membership matrix of a grid, built once and cached on disk by grid hash
+def get_membership(sites, lat, lon, cache_dir=None):
+    key = (grid_hash(lat, lon), sites_hash(sites))
+    if key not in _memberships:
+        _memberships[key] = load_or_build_weights(
+            cache_dir, f"sites_{key[0]}_{key[1]}.npz", lambda: membership_weights(sites, lat, lon)
+        )
+    return _memberships[key]
+
+# Function to crop a membership matrix to the smallest (y, x) window holding all its pixels,
+# so only that hyperslab has to be read. Returns (y slice, x slice, cropped matrix)
+def crop_to_window(weights, shape):
+    ny, nx = shape
+    pixels = np.unique(weights.indices)
+    if len(pixels) == 0:
+        return slice(0, 0), slice(0, 0), sparse.csr_matrix((weights.shape[0], 0))
+    iy, ix = pixels // nx, pixels % nx
+    y0, y1, x0, x1 = iy.min(), iy.max() + 1, ix.min(), ix.max() + 1
+    cols = (weights.indices // nx - y0) * (x1 - x0) + weights.indices % nx - x0
+    cropped = sparse.csr_matrix((weights.data, cols, weights.indptr),
+                                shape=(weights.shape[0], (y1 - y0) * (x1 - x0)))
+    return slice(int(y0), int(y1)), slice(int(x0), int(x1)), cropped
@@ -0,0 +1,58 @@
+import os
+import warnings
+import numpy as np
+import pandas as pd
+import netCDF4 as nc
+from climatology import file_dates
+from trends import trend_map, write_trend_map
+
+# Products to analyse: folder with the daily (or monthly) cubes, variable name and units
+products = {
+    'HCHO': {'dir': 'D:/Data/SP/HCHO', 'var': 'HCHO', 'units': "mol m-2"},
+    'NO2': {'dir': 'D:/Data/SP/NO2', 'var': 'NO2', 'units': "mol m-2"},
+    'FNR': {'dir': 'D:/Data/SP/FNR', 'var': 'FNR', 'units': "1"},
+    'O3_TROP': {'dir': 'D:/Data/FR/O3_TROP', 'var': 'O3_TROP', 'units': "mol m-2"},
+}
+output_dir = 'D:/Data/SP/TRENDS'
+years = range(2019, 2024)
+
+# Fit the monthly means with their mean seasonal cycle removed, and add Theil-Sen slopes
+deseasonal = True
+theil_sen = True
+max_chunk_mb = 256
+
+# Function to read a folder of cubes as a series of monthly mean fields (one file at a time)
+def monthly_series(folder, var_name, years):
+    dates, fields, lat, lon = [], [], None, None
+    for name in sorted(f for f in os.listdir(folder) if f.endswith('.nc')):
+        with nc.Dataset(os.path.join(folder, name), 'r') as ds:
+            # Skip files without any day (e.g. a month with no overpass) and years not analysed
+            file_days = file_dates(ds, name)
+            if len(file_days) == 0 or file_days[0].year not in years:
+                continue
+            if lat is None:
+                lat, lon = ds.variables['y'][:], ds.variables['x'][:]
+            data = np.ma.filled(np.ma.asarray(ds.variables[var_name][:], dtype='f8'), np.nan)
+
+        # Daily cubes are averaged into a monthly mean field, dated mid-month
+        if data.ndim == 3:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', RuntimeWarning)
+                data = np.nanmean(data, axis=0)
+        dates.append(file_days[0].replace(day=15))
+        fields.append(data)
+    if len(fields) == 0:
+        return pd.DatetimeIndex(dates), None, lat, lon
+    return pd.DatetimeIndex(dates), np.stack(fields), lat, lon
+
+os.makedirs(output_dir, exist_ok=True)
+for product, info in products.items():
+    dates, cube, lat, lon = monthly_series(info['dir'], info['var'], years)
+    if cube is None:
+        print(f"{product}: no months with data in {info['dir']}, skipped")
+        continue
+    results = trend_map(dates, cube, deseasonal=deseasonal, theil_sen=theil_sen, max_chunk_mb=max_chunk_mb)
+
+    output_file = os.path.join(output_dir, f"{product}_TRENDS_{years[0]}_{years[-1]}.nc")
+    write_trend_map(output_file, lat, lon, results, info['var'], info['units'], deseasonal)
+    print(f"{product}: {len(dates)} months, trend map saved to {output_file}")
@@ -0,0 +1,133 @@
+import warnings
+import numpy as np
+import pandas as pd
+from scipy import stats
+from netCDF4 import Dataset
+
+# Output fields of trend_map, with their long names; slopes are per year
+TREND_FIELDS = {
+    'slope': "OLS linear trend",
+    'slope_stderr': "Standard error of the OLS linear trend",
+    'intercept': "OLS intercept (at year 0)",
+    'p_value': "Two-sided p-value of the OLS linear trend",
+    'theil_sen_slope': "Theil-Sen linear trend",
+    'n_valid': "Number of valid values",
+}
+
+# Function to convert dates to decimal years
+def decimal_years(dates):
+    dates = pd.DatetimeIndex(dates)
+    days_in_year = np.where(dates.is_leap_year, 366.0, 365.0)
+    return dates.year + (dates.dayofyear - 1 + dates.hour / 24.0) / days_in_year
+
+# Function to remove the mean seasonal cycle: the per-pixel mean of each calendar month
+# (over all years) is subtracted from the values of that month
+def deseasonalize(dates, data):
+    months = pd.DatetimeIndex(dates).month.to_numpy()
+    anomalies = np.array(data, dtype='f8')
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for month in np.unique(months):
+            anomalies[months == month] -= np.nanmean(anomalies[months == month], axis=0)
+    return anomalies
+
+# Function to fit OLS lines to every column of a (t, n) array in closed form, skipping NaN
+# values per column. Gives the same slope, intercept, standard error and p-value as linregress
+def ols_trend(t, data):
+    t = np.asarray(t, dtype='f8')[:, np.newaxis]
+    valid = ~np.isnan(data)
+    n = valid.sum(axis=0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_mean = np.where(valid, t, 0.0).sum(axis=0) / n
+        y_mean = np.where(valid, data, 0.0).sum(axis=0) / n
+        dt = np.where(valid, t - t_mean, 0.0)
+        dy = np.where(valid, data - y_mean, 0.0)
+        sxx = (dt ** 2).sum(axis=0)
+        sxy = (dt * dy).sum(axis=0)
+        syy = (dy ** 2).sum(axis=0)
+
+        slope = sxy / sxx
+        intercept = y_mean - slope * t_mean
+        dof = n - 2
+        stderr = np.sqrt(np.maximum(syy - slope * sxy, 0.0) / dof / sxx)
+        p_value = 2 * stats.t.sf(np.abs(slope / stderr), np.maximum(dof, 1))
+
+    # At least 3 values at distinct times are needed for a slope with an uncertainty
+    bad = (n < 3) | (sxx <= 0)
+    for field in (slope, intercept, stderr, p_value):
+        field[bad] = np.nan
+    p_value[~bad & (stderr == 0)] = 0.0
+    return slope, intercept, stderr, p_value, n
+
+# Function to compute Theil-Sen slopes (median of all pairwise slopes) of every column of
+# a (t, n) array, skipping pairs with a NaN value; columns are processed in chunks whose
+# pairwise-slope array fits in max_chunk_mb
+def theil_sen_slope(t, data, max_chunk_mb=256):
+    t = np.asarray(t, dtype='f8')
+    i, j = np.triu_indices(len(t), k=1)
+    keep = t[j] != t[i]
+    i, j = i[keep], j[keep]
+    dt = (t[j] - t[i])[:, np.newaxis]
+
+    n_cols = data.shape[1]
+    chunk = max(1, int(max_chunk_mb * 2 ** 20 // (8 * max(len(i), 1))))
+    slopes = np.full(n_cols, np.nan)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for start in range(0, n_cols, chunk):
+            block = data[:, start:start + chunk]
+            slopes[start:start + chunk] = np.nanmedian((block[j] - block[i]) / dt, axis=0)
+    return slopes
+
+# Function to compute the trend maps of a (t, y, x) cube: OLS slope, standard error, intercept
+# and p-value, Theil-Sen slope and number of valid values, all per year and per pixel
+def trend_map(dates, cube, deseasonal=False, theil_sen=True, max_chunk_mb=256):
+    cube = np.ma.filled(np.ma.asarray(cube, dtype='f8'), np.nan)
+    if deseasonal:
+        cube = deseasonalize(dates, cube)
+    t = decimal_years(dates)
+    data = cube.reshape(len(t), -1)
+
+    # Pixels are processed in chunks; the OLS fit needs about six (t, chunk) temporaries
+    n_cols = data.shape[1]
+    chunk = max(1, int(max_chunk_mb * 2 ** 20 // (8 * 6 * len(t))))
+    results = {name: np.full(n_cols, np.nan) for name in ('slope', 'slope_stderr', 'intercept', 'p_value')}
+    results['n_valid'] = np.zeros(n_cols, dtype='i4')
+    if theil_sen:
+        results['theil_sen_slope'] = np.full(n_cols, np.nan)
+
+    for start in range(0, n_cols, chunk):
+        cols = slice(start, start + chunk)
+        block = data[:, cols]
+        fields = ols_trend(t, block)
+        for name, values in zip(('slope', 'intercept', 'slope_stderr', 'p_value', 'n_valid'), fields):
+            results[name][cols] = values
+        if theil_sen:
+            results['theil_sen_slope'][cols] = theil_sen_slope(t, block, max_chunk_mb)
+    return {name: values.reshape(cube.shape[1:]) for name, values in results.items()}
+
+# Function to write trend maps to a NetCDF file
+def write_trend_map(path, lat, lon, results, var_name, units, deseasonal=False):
+    with Dataset(path, 'w', format='NETCDF4') as ds_out:
+        ds_out.createDimension('x', len(lon))
+        ds_out.createDimension('y', len(lat))
+
+        x_out = ds_out.createVariable('x', 'f4', ('x',))
+        y_out = ds_out.createVariable('y', 'f4', ('y',))
+        x_out.standard_name, x_out.units, x_out.long_name = "longitude", "degrees_east", "Longitude"
+        y_out.standard_name, y_out.units, y_out.long_name = "latitude", "degrees_north", "Latitude"
+        x_out[:] = lon
+        y_out[:] = lat
+
+        for name, values in results.items():
+            if name == 'n_valid':
+                out = ds_out.createVariable(f"{var_name}_{name}", 'i4', ('y', 'x'))
+                out.units = "1"
+            else:
+                out = ds_out.createVariable(f"{var_name}_{name}", 'f4', ('y', 'x'), fill_value=np.nan)
+                out.units = "1" if name == 'p_value' else (units if name == 'intercept' else f"{units} year-1")
+            out.long_name = f"{TREND_FIELDS[name]} of {var_name}"
+            out[:] = values
+
+        ds_out.deseasonalized = int(deseasonal)
@@ -2,162 +2,244 @@ import os
 import numpy as np
 import netCDF4 as nc
 import xarray as xr
-from scipy.interpolate import griddata
+from regridding import get_regridder, grid_hash
+from file_catalog import FileCatalog
+from merra2_subset import domain_slices
+from parallel_months import atomic_output, run_months
+from netcdf_writer import DailyNetCDFWriter
+from regrid_cache import RegriddedFieldCache
 
 # Paths
 merra_o3_delp_dir = r"D:\Data\FR\MERRA2\O3_AND_DELP"
 merra_troppb_dir = r"D:\Data\FR\MERRA2\TROPPB"
 tropomi_dir = r"D:\Data\FR\O3"
 output_dir = r"D:\Data\FR\O3_TROP"
+weights_dir = r"D:\Data\FR\MERRA2\WEIGHTS"
+catalog_path = r"D:\Data\FR\MERRA2\catalog.sqlite"
+field_cache_dir = r"D:\Data\FR\MERRA2\REGRIDDED"
+
+# Size limit (GB) of the regridded-field cache; least recently used fields are evicted above it
+field_cache_max_gb = 20.0
+
+# Regridding of MERRA-2 fields to the TROPOMI grid: 'linear' or 'conservative' (area-weighted)
+regrid_method = 'linear'
+
+# Memory budget (MB) for one chunk of days of MERRA-2 fields and the ozone kernel's temporaries;
+# granules are read, reduced and regridded chunk by chunk within it
+max_chunk_mb = 512
+
+# Output chunk shape (t, y, x) and compression level; None writes one day per chunk
+nc_chunk_shape = None
+nc_complevel = 4
+
+# Parallel execution: number of worker processes (1 = serial), attempts per month,
+# per-month log folder, and an optional list of (year, month) to (re)run only those months
+workers = 1
+retries = 2
+log_dir = os.path.join(output_dir, "logs")
+only_months = None
 
 # Create output folder if it doesn't exist
 os.makedirs(output_dir, exist_ok=True)
 
-def find_file_by_date(folder, date_str):
-    # Searches for a file that ends with the given date string inside the folder
-    suffix = f"{date_str}.SUB.nc"
-    for f in os.listdir(folder):
-        if f.endswith(suffix):
-            return os.path.join(folder, f)
-    return None
+# MERRA-2 file catalog (each worker process opens its own connection)
+catalog = FileCatalog(catalog_path)
+
+# Cache of MERRA-2 ratios already regridded to the TROPOMI grid
+field_cache = RegriddedFieldCache(field_cache_dir, max_gb=field_cache_max_gb)
 
 def compute_mid_pressure(delp):
     # Computes mid-level pressures by integrating DELP (Dry Layer Pressure Thickness)
-    nlev = delp.shape[0]
-    p_interface = np.zeros((nlev + 1, delp.shape[1], delp.shape[2]), dtype=delp.dtype)
-    for k in range(1, nlev + 1):
-        p_interface[k, :, :] = p_interface[k - 1, :, :] + delp[k - 1, :, :]
-    p_mid = 0.5 * (p_interface[:-1, :, :] + p_interface[1:, :, :])
+    # along the level axis; works for (lev, lat, lon) and (t, lev, lat, lon) arrays
+    p_mid = np.cumsum(delp, axis=-3)
+    p_mid -= 0.5 * delp
     return p_mid
 
-def compute_tropospheric_ozone(o3, delp, troppb):
-    # Computes the tropospheric and total ozone columns and their ratio
+def compute_tropospheric_ozone_batch(o3, delp, troppb, chunk_size=None):
+    # Computes the tropospheric and total ozone columns and their ratio for a whole
+    # month at once: o3 and delp are (t, lev, lat, lon), troppb is (t, lat, lon)
     if o3.shape != delp.shape:
-        raise ValueError("o3 and delp must have the same shape (nlev, nlat, nlon)")
-
-    # Calculate pressure at mid-levels
-    p_mid = compute_mid_pressure(delp)
+        raise ValueError("o3 and delp must have the same shape (t, nlev, nlat, nlon)")
 
-    # Select layers within the troposphere (pressure >= TROPPB)
-    mask_trop = p_mid >= troppb[np.newaxis, :, :]
+    nt = o3.shape[0]
+    o3_trop = np.empty((nt,) + o3.shape[2:], dtype='f4')
+    o3_total = np.empty_like(o3_trop)
+    chunk_size = nt if chunk_size is None else max(1, int(chunk_size))
 
-    # Integrate ozone using DELP as weight
-    with np.errstate(invalid='ignore', divide='ignore'):
-        o3_trop = np.nansum(np.where(mask_trop, o3 * delp, 0.0), axis=0)
-        o3_total = np.nansum(o3 * delp, axis=0)
-        ratio = np.where(o3_total != 0.0, o3_trop / o3_total, 0.0)
-
-    return o3_trop, o3_total, ratio
+    # Process the days in chunks so the temporaries stay within the memory budget
+    for start in range(0, nt, chunk_size):
+        sl = slice(start, start + chunk_size)
+        delp_c = np.ma.filled(delp[sl], np.nan).astype('f4', copy=False)
+        o3_c = np.ma.filled(o3[sl], np.nan).astype('f4', copy=False)
+        troppb_c = np.ma.filled(troppb[sl], np.nan).astype('f4', copy=False)
 
-# Loop over all years and months
-for year in range(2019, 2024):
-    for month in range(1, 13):
-        # Build TROPOMI file path
-        tropomi_name = f"FR_O3_{year}_{month:02d}.nc"
-        tropomi_path = os.path.join(tropomi_dir, tropomi_name)
+        # Select layers within the troposphere (pressure >= TROPPB)
+        mask_trop = compute_mid_pressure(delp_c) >= troppb_c[:, np.newaxis, :, :]
 
-        # Skip if monthly TROPOMI file does not exist
-        if not os.path.exists(tropomi_path):
-            continue
+        # Integrate ozone using DELP as weight
+        o3_mass = o3_c * delp_c
+        np.nansum(o3_mass, axis=1, out=o3_total[sl])
+        o3_mass[~mask_trop] = 0.0
+        np.nansum(o3_mass, axis=1, out=o3_trop[sl])
 
-        # Open TROPOMI dataset and extract coordinates
-        ds_tropomi = xr.open_dataset(tropomi_path)
-        lat_tropomi = ds_tropomi['y'].values
-        lon_tropomi = ds_tropomi['x'].values
-        lons, lats = np.meshgrid(lon_tropomi, lat_tropomi)
-        dates = ds_tropomi['t'].values
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ratio = np.where(o3_total != 0.0, o3_trop / o3_total, 0.0).astype('f4')
 
-        o3_trop_month = []
-        time_days = []
+    return o3_trop, o3_total, ratio
 
-        # Loop through each daily observation in the month
-        for idx, date in enumerate(dates):
-            date_str = np.datetime_as_string(date, unit='D').replace('-', '')
+def compute_tropospheric_ozone(o3, delp, troppb):
+    # Computes the tropospheric and total ozone columns and their ratio for a single day
+    if o3.shape != delp.shape:
+        raise ValueError("o3 and delp must have the same shape (nlev, nlat, nlon)")
+    o3_trop, o3_total, ratio = compute_tropospheric_ozone_batch(
+        o3[np.newaxis], delp[np.newaxis], troppb[np.newaxis]
+    )
+    return o3_trop[0], o3_total[0], ratio[0]
+
+def chunk_days_for_budget(nlev, nlat, nlon, budget_mb):
+    # Number of days per chunk so that the O3 and DELP inputs plus ~4 float32 (lev, lat, lon)
+    # kernel temporaries fit the budget
+    bytes_per_day = 6 * 4 * nlev * nlat * nlon
+    return max(1, int(budget_mb * 1024 ** 2 // bytes_per_day))
+
+def compute_regridded_ratios(day_paths, lat_tropomi, lon_tropomi):
+    # Computes the MERRA-2 trop/total ozone ratio of the given days and regrids it to the TROPOMI
+    # grid; day_paths holds (date_str, o3_delp_path, troppb_path) tuples. Yields (start, ratios)
+    # for each chunk of days, the ratios being the float32 (t, y, x) fields of days start, start+1...
+
+    # Read the MERRA-2 grid from the first granule and find the hyperslab covering
+    # the TROPOMI domain plus an interpolation halo; only that part is read below
+    with nc.Dataset(day_paths[0][1]) as ds_o3:
+        lat_sl, lon_sl = domain_slices(ds_o3.variables['lat'][:], ds_o3.variables['lon'][:],
+                                       lat_tropomi, lon_tropomi)
+        lats_merra = ds_o3.variables['lat'][lat_sl]
+        lons_merra = ds_o3.variables['lon'][lon_sl]
+        nlev = ds_o3.variables['O3'].shape[1]
+
+    # Interpolation weights of the MERRA-2 -> TROPOMI grid pair, reused for every chunk
+    regridder = get_regridder(lats_merra, lons_merra, lat_tropomi, lon_tropomi,
+                              cache_dir=weights_dir, method=regrid_method)
+
+    # Days are read, reduced to their ratio and regridded one chunk at a time, so only one chunk
+    # of (t, lev, lat, lon) MERRA-2 fields and of regridded ratios is in memory
+    nt, nlat, nlon = len(day_paths), len(lats_merra), len(lons_merra)
+    chunk_days = chunk_days_for_budget(nlev, nlat, nlon, max_chunk_mb)
+    for start in range(0, nt, chunk_days):
+        chunk = day_paths[start:start + chunk_days]
+        o3 = np.empty((len(chunk), nlev, nlat, nlon), dtype='f4')
+        delp = np.empty((len(chunk), nlev, nlat, nlon), dtype='f4')
+        troppb = np.empty((len(chunk), nlat, nlon), dtype='f4')
+
+        # Load MERRA-2 O3, DELP and TROPPB for the days of the chunk
+        for i, (date_str, o3_delp_path, troppb_path) in enumerate(chunk):
+            with nc.Dataset(o3_delp_path) as ds_o3:
+                o3[i] = np.ma.filled(ds_o3.variables['O3'][0, :, lat_sl, lon_sl], np.nan)
+                delp[i] = np.ma.filled(ds_o3.variables['DELP'][0, :, lat_sl, lon_sl], np.nan)
+            with nc.Dataset(troppb_path) as ds_tr:
+                troppb[i] = np.ma.filled(ds_tr.variables['TROPPB'][0, lat_sl, lon_sl], np.nan)
 
-            # Find corresponding MERRA-2 files for O3/DELP and TROPPB
-            o3_delp_path = find_file_by_date(merra_o3_delp_dir, date_str)
-            troppb_path = find_file_by_date(merra_troppb_dir, date_str)
+        # Compute tropospheric-to-total ozone ratio from MERRA-2 for the chunk at once
+        o3_trop, o3_total, ratio_chunk = compute_tropospheric_ozone_batch(o3, delp, troppb)
+        for (date_str, _, _), ratio in zip(chunk, ratio_chunk):
+            print(f"{date_str} - Mean O3 trop/total ratio (MERRA2): {np.nanmean(ratio):.3f}")
 
-            # Skip if one of the MERRA files is missing
-            if o3_delp_path is None or troppb_path is None:
-                continue
+        yield start, regridder.regrid(ratio_chunk).astype('f4')
 
-            # Load MERRA-2 O3 and DELP
-            with nc.Dataset(o3_delp_path) as ds_o3:
-                o3 = ds_o3.variables['O3'][0, :, :, :]
-                delp = ds_o3.variables['DELP'][0, :, :, :]
-                lats_merra = ds_o3.variables['lat'][:]
-                lons_merra = ds_o3.variables['lon'][:]
+def process_month(year, month):
+    # Computes and saves the tropospheric ozone file of one month; returns its path
+    # Build TROPOMI file path
+    tropomi_name = f"FR_O3_{year}_{month:02d}.nc"
+    tropomi_path = os.path.join(tropomi_dir, tropomi_name)
 
-            # Load MERRA-2 TROPPB
-            with nc.Dataset(troppb_path) as ds_tr:
-                troppb = ds_tr.variables['TROPPB'][0, :, :]
+    # Skip if monthly TROPOMI file does not exist
+    if not os.path.exists(tropomi_path):
+        return None
 
-            # Compute tropospheric-to-total ozone ratio from MERRA-2
-            o3_trop, o3_total, ratio = compute_tropospheric_ozone(o3, delp, troppb)
-            print(f"{date_str} - Mean O3 trop/total ratio (MERRA2): {np.nanmean(ratio):.3f}")
+    # Open TROPOMI dataset and extract coordinates
+    ds_tropomi = xr.open_dataset(tropomi_path)
+    lat_tropomi = ds_tropomi['y'].values
+    lon_tropomi = ds_tropomi['x'].values
+    dates = ds_tropomi['t'].values
 
-            # Interpolate the MERRA-2 ratio to TROPOMI resolution
-            lon_grid, lat_grid = np.meshgrid(lons_merra, lats_merra)
-            points = np.column_stack((lon_grid.flatten(), lat_grid.flatten()))
-            values_ratio = ratio.flatten()
-            ratio_interp = griddata(points, values_ratio, (lons, lats), method='linear')
+    day_paths = []
+    day_idx = []
+    time_days = []
 
-            # Scale TROPOMI total column using the MERRA-2 ratio
-            o3_tropomi = ds_tropomi['O3'][idx].values
-            o3_scaled = ratio_interp * o3_tropomi
-            o3_trop_month.append(o3_scaled)
+    # Loop through each daily observation in the month
+    for idx, date in enumerate(dates):
+        date_str = np.datetime_as_string(date, unit='D').replace('-', '')
 
-            # Convert time to "days since 1990-01-01"
-            ref_date = np.datetime64('1990-01-01')
-            delta_days = (date - ref_date).astype('timedelta64[D]').astype(int)
-            time_days.append(delta_days)
+        # Find corresponding MERRA-2 files for O3/DELP and TROPPB
+        o3_delp_path = catalog.find('MERRA2', 'O3', date_str)
+        troppb_path = catalog.find('MERRA2', 'TROPPB', date_str)
 
-        # Skip if no valid daily data were processed
-        if len(o3_trop_month) == 0:
+        # Skip if one of the MERRA files is missing
+        if o3_delp_path is None or troppb_path is None:
             continue
 
-        o3_trop_month = np.array(o3_trop_month)
-        time_days = np.array(time_days)
-
-        # Create output NetCDF file
-        nc_out = os.path.join(output_dir, f"FR_O3_TROP_{year}_{month:02d}.nc")
-        with nc.Dataset(nc_out, 'w', format='NETCDF4') as ds_out:
-            # Define dimensions
-            ds_out.createDimension('t', None)
-            ds_out.createDimension('y', len(lat_tropomi))
-            ds_out.createDimension('x', len(lon_tropomi))
-
-            # Create coordinate variables
-            t_var = ds_out.createVariable('t', 'i4', ('t',))
-            y_var = ds_out.createVariable('y', 'f8', ('y',))
-            x_var = ds_out.createVariable('x', 'f8', ('x',))
-
-            # Create data variable for tropospheric ozone
-            o3_var = ds_out.createVariable('O3_TROP', 'f4', ('t', 'y', 'x'), fill_value=np.nan, zlib=True)
-            crs_var = ds_out.createVariable('crs', 'c')
-
-            # Assign metadata to variables
-            t_var.standard_name = "time"
-            t_var.long_name = "time"
-            t_var.units = "days since 1990-01-01"
-            t_var.axis = "T"
-
-            y_var.standard_name = "latitude"
-            y_var.long_name = "latitude"
-            y_var.units = "degrees_north"
-
-            x_var.standard_name = "longitude"
-            x_var.long_name = "longitude"
-            x_var.units = "degrees_east"
-
-            o3_var.long_name = "Tropospheric ozone column estimated by scaling TROPOMI total column with MERRA2 ratio"
-            o3_var.units = "mol m-2"
-
-            # Write data to output file
-            t_var[:] = time_days
-            y_var[:] = lat_tropomi
-            x_var[:] = lon_tropomi
-            o3_var[:, :, :] = o3_trop_month
-
-        print(f"Saved monthly file: {nc_out}")
\ No newline at end of file
+        day_paths.append((date_str, o3_delp_path, troppb_path))
+        day_idx.append(idx)
+
+        # Convert time to "days since 1990-01-01"
+        ref_date = np.datetime64('1990-01-01')
+        delta_days = (date - ref_date).astype('timedelta64[D]').astype(int)
+        time_days.append(delta_days)
+
+    # Skip if no valid daily data were processed
+    if len(day_paths) == 0:
+        return None
+
+    # Get the MERRA-2 ratio on the TROPOMI grid for every day, from the regridded-field
+    # cache when possible; only the missing days are read, computed and regridded
+    # The keys include the MERRA-2 hyperslab read for the TROPOMI domain, so a change of domain
+    # is never served a field computed from a different subset
+    grid_key = grid_hash(lat_tropomi, lon_tropomi)
+    with nc.Dataset(day_paths[0][1]) as ds_o3:
+        domain = domain_slices(ds_o3.variables['lat'][:], ds_o3.variables['lon'][:], lat_tropomi, lon_tropomi)
+    keys = [field_cache.key([o3_delp_path, troppb_path], 'O3_TROP_RATIO', grid_key, regrid_method, domain=domain)
+            for _, o3_delp_path, troppb_path in day_paths]
+    # Cached fields are memory-mapped, so the month holds no field data; missing days are computed
+    # chunk by chunk and stored, then served from the cache like the others
+    ratio_fields = [field_cache.get(key) for key in keys]
+    missing = [i for i, field in enumerate(ratio_fields) if field is None]
+    if len(missing) > 0:
+        for start, ratio_chunk in compute_regridded_ratios([day_paths[i] for i in missing], lat_tropomi, lon_tropomi):
+            for i, field in zip(missing[start:start + len(ratio_chunk)], ratio_chunk):
+                field_cache.put(keys[i], field)
+                cached = field_cache.get(keys[i])
+                ratio_fields[i] = field if cached is None else cached
+
+    # Scale the TROPOMI total column using the MERRA-2 ratio
+    variables = {
+        'O3_TROP': {
+            'long_name': "Tropospheric ozone column estimated by scaling TROPOMI total column with MERRA2 ratio",
+            'units': "mol m-2",
+        }
+    }
+
+    # Create output NetCDF file (written to a temporary file first, then renamed) and
+    # append each block of days as soon as it is computed
+    nc_out = os.path.join(output_dir, f"FR_O3_TROP_{year}_{month:02d}.nc")
+    block_days = nc_chunk_shape[0] if nc_chunk_shape else 1
+    with atomic_output(nc_out) as nc_tmp, DailyNetCDFWriter(
+        nc_tmp, lat_tropomi, lon_tropomi, variables, chunk_shape=nc_chunk_shape, complevel=nc_complevel
+    ) as writer:
+        writer.ds.createVariable('crs', 'c')
+        for start in range(0, len(day_idx), block_days):
+            block = slice(start, start + block_days)
+            ratio_interp = np.stack(ratio_fields[block])
+            o3_tropomi = ds_tropomi['O3'][day_idx[block]].values
+            writer.append(time_days[block], O3_TROP=ratio_interp * o3_tropomi)
+
+    ds_tropomi.close()
+    print(f"Saved monthly file: {nc_out}")
+    return nc_out
+
+if __name__ == "__main__":
+    # Index the MERRA-2 folders once; only new or changed granules are scanned again
+    catalog.refresh(merra_o3_delp_dir, 'MERRA2', 'O3')
+    catalog.refresh(merra_troppb_dir, 'MERRA2', 'TROPPB')
+
+    # Loop over all years and months
+    jobs = only_months or [(year, month) for year in range(2019, 2024) for month in range(1, 13)]
+    run_months(process_month, jobs, workers=workers, retries=retries, log_dir=log_dir)
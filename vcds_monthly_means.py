@@ -1,5 +1,7 @@
 import os
+import numpy as np
 from netCDF4 import Dataset
+from climatology import WelfordAccumulator
 
 # Directories
 input_dir = r'D:\Data\FR\HCHO_MEAN'
@@ -25,12 +27,12 @@ for month in range(1, 13):
         continue
 
     # Initialize variables
-    all_hcho = []
+    accumulator = None
     x_data = None
     y_data = None
 
-    # Load all files for the current month
-    for hcho_file in monthly_files:
+    # Stream the files for the current month into the accumulator, one at a time
+    for hcho_file in sorted(monthly_files):
         input_file = os.path.join(input_dir, hcho_file)
 
         # Load data from file
@@ -40,18 +42,15 @@ for month in range(1, 13):
         if x_data is None:
             x_data = hcho_data['x']
             y_data = hcho_data['y']
+            accumulator = WelfordAccumulator(hcho_data['HCHO_mean'].shape)
+        elif hcho_data['HCHO_mean'].shape != accumulator.mean.shape:
+            raise ValueError(f"{hcho_file} does not share the grid of the other month {month:02d} files")
 
-        # Append HCHO_mean data (do not average here since they are already monthly means)
-        all_hcho.append(hcho_data['HCHO_mean'])
+        # Add HCHO_mean data (they are already monthly means); NaN/fill pixels are skipped
+        accumulator.add(hcho_data['HCHO_mean'])
 
-    # Calculate mean across all files
-    hcho_sum = None
-    for hcho in all_hcho:
-        if hcho_sum is None:
-            hcho_sum = hcho
-        else:
-            hcho_sum += hcho
-    hcho_mean = hcho_sum / len(all_hcho)
+    # Per-pixel mean, standard deviation and number of valid years
+    hcho_mean, hcho_std, hcho_count = accumulator.result()
 
     # Create new NetCDF file with the monthly mean
     output_file = os.path.join(output_dir, f'HCHO_MEAN_ALL_YEARS_{month:02d}.nc')
@@ -64,7 +63,9 @@ for month in range(1, 13):
         # Create variables
         x_out = ds_out.createVariable('x', 'f4', ('x',))
         y_out = ds_out.createVariable('y', 'f4', ('y',))
-        hcho_mean_out = ds_out.createVariable('HCHO_mean', 'f4', ('y', 'x'))
+        hcho_mean_out = ds_out.createVariable('HCHO_mean', 'f4', ('y', 'x'), fill_value=np.nan)
+        hcho_std_out = ds_out.createVariable('HCHO_std', 'f4', ('y', 'x'), fill_value=np.nan)
+        hcho_count_out = ds_out.createVariable('HCHO_count', 'i2', ('y', 'x'))
 
         # Set attributes
         x_out.standard_name = "longitude"
@@ -79,9 +80,17 @@ for month in range(1, 13):
         hcho_mean_out.units = "mol m-2"
         hcho_mean_out.long_name = "Mean Formaldehyde concentration"
 
+        hcho_std_out.units = "mol m-2"
+        hcho_std_out.long_name = "Standard deviation of the Formaldehyde concentration across years"
+
+        hcho_count_out.units = "1"
+        hcho_count_out.long_name = "Number of years with valid data"
+
         # Save data
         x_out[:] = x_data
         y_out[:] = y_data
         hcho_mean_out[:] = hcho_mean
+        hcho_std_out[:] = hcho_std
+        hcho_count_out[:] = hcho_count
 
     print(f"Monthly mean for month {month:02d} processed and saved to: {output_file}")